@@ -1,4 +1,6 @@
+import collections
 import numpy as np
+import pandas as pd
 
 def user_input(msg, typ=['y', 'n', 'a', 'q']):
     """Handlt terminal user input"""
@@ -29,59 +31,140 @@ def round_tol(self, val, tol):
     """round to match tolarance"""
     return round(val, self.get_precision(tol)[1] + 1)
 
+FilterStage = collections.namedtuple('FilterStage', ['name', 'column', 'removed'])
+
+class Filt(object):
+    """Chainable row filter for apply_filters.
+
+    A Filt is an ordered list of stages. Each stage is a function
+    f(values)-->bool array of good values (values to keep) evaluated on the
+    rows still kept by the previous stages, so statistics (mean, std) are
+    computed exactly as when the filt_* functions are nested. Combine with &:
+
+        df_filt = apply_filters(df, gt(0) & sigma(3) & edge_pct(0.05), ['Thickness'])
+
+    Attributes:
+        stages (list): (name, func, columns) tuples, applied in order.
+    """
+
+    def __init__(self, func, name=None, columns=None):
+        """
+        Args:
+            func (func): f(values)-->bool array of good values; values is a np.array.
+            name (:obj:`str`, optional): name used in the report.
+            columns (:obj:`list`, optional): columns for this stage, overrides the
+                columns given to apply_filters.
+        """
+        if name is None:
+            name = getattr(func, '__name__', 'filt')
+        self.stages = [(name, func, columns)]
+
+    def __and__(self, other):
+        if not isinstance(other, Filt):
+            return NotImplemented
+        out = Filt.__new__(Filt)
+        out.stages = self.stages + other.stages
+        return out
+
+    def __repr__(self):
+        return ' & '.join(name for name, _, _ in self.stages)
+
+def gt(val=0, columns=None):
+    """Filt keeping values greater than val"""
+    return Filt(lambda data: data > val, 'gt(%s)' % val, columns)
+
+def lt(val=0, columns=None):
+    """Filt keeping values less than val"""
+    return Filt(lambda data: data < val, 'lt(%s)' % val, columns)
+
+def sigma(sig=3, columns=None):
+    """Filt keeping values within sig sigma of the mean"""
+    def filt(data):
+        av = np.nanmean(data)
+        sd = np.nanstd(data, ddof=1)  # match pandas Series.std
+        return np.abs(data-av) <= sig*sd
+    return Filt(filt, 'sigma(%s)' % sig, columns)
+
+def edge_pct(per=0.05, columns=None):
+    """Filt keeping values within per (fraction) of the mean"""
+    def filt(data):
+        av = np.nanmean(data)
+        return np.abs((data-av)/av) <= per
+    return Filt(filt, 'edge_pct(%s)' % per, columns)
+
+def _column_name(df, item):
+    """accept both index or column name"""
+    if isinstance(item, int):
+        return df.columns[item]
+    return item
+
+def filter_mask(df, filt, columns=None):
+    """Return (mask, report) for filt applied to df without copying df.
+     Args:
+        df (pd.dataframe): pandas dataframe of one to many columns.
+        filt (Filt): single filter or chain (gt(0) & sigma(3)).
+        columns (list): list of column names (str) or indicies(ints)
+    Returns:
+        mask (np.array): bool array of rows to keep.
+        report (list): FilterStage(name, column, removed) for each stage and column.
+    """
+    keep = np.ones(len(df), dtype=bool)
+    report = []
+    for name, func, stage_columns in filt.stages:
+        if stage_columns is None:
+            stage_columns = columns or []
+        for item in stage_columns:
+            column = _column_name(df, item)
+            # only evaluate the rows still kept so stats match nested filters
+            ind = np.flatnonzero(keep)
+            if ind.size:
+                values = df[column].to_numpy()[ind]
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    good = np.asarray(func(values), dtype=bool)
+                keep[ind[~good]] = False
+                removed = int(ind.size - np.count_nonzero(good))
+            else:
+                removed = 0
+            report.append(FilterStage(name, column, removed))
+    return keep, report
+
+def apply_filters(df, filt, columns=None, report=False):
+    """Return df subseted by filt in a single pass (one mask, one take).
+     Args:
+        df (pd.dataframe): pandas dataframe of one to many columns.
+        filt (Filt): single filter or chain (gt(0) & sigma(3)).
+        columns (list): list of column names (str) or indicies(ints)
+        report (:obj:`bool`, optional): also return list of FilterStage.
+    """
+    keep, stages = filter_mask(df, filt, columns)
+    dfn = df.take(np.flatnonzero(keep))
+    # reset the indicies so they start at 0 and are continuous
+    dfn.index = pd.RangeIndex(len(dfn))
+    if report:
+        return dfn, stages
+    return dfn
+
 def filter_data(df, filt, columns):
     """Return df subseted by function filt(x) on x = columns.
      Args:
         df (pd.dataframe): pandas dataframe of one to many columns.
-        filter (func): f(x)-->bool array of good values (values to keep); where x is list or np.array.
+        filter (func): f(x)-->bool array of good values (values to keep); where x is pd.Series.
         columns (list): list of column namse (str) or indicies(ints)
     """
-    dfn = df.copy(deep=True)
-    #dfn.sort_index(inplace=True) # make sure it is sorted by its index (data frames can be weird) - not needed now bc using 
-    for item in columns:
-        # accept both index or column name
-        column = item
-        if isinstance(item, int):  # could also have used df.iloc[rows, cols]
-            column = dfn.columns[item]
-        # get where(bool array) --> indicies of bad values   # old way
-        #ind = np.where(~filt(dfn[column].values))[0]   # old way
-        # get bool aray of good values
-        tf_df = filt(dfn[column])
-        
-        #dfn = dfn.drop(ind.tolist(), axis=0, inplace=False)   # old way
-        dfn = dfn[tf_df]  #wahaha giving it a boolean array selects from rows rather than columns, WTF?
-        
-        # reset the indicies so they start at 0 and are continuous
-        dfn = dfn.reset_index(drop=True)
-    return dfn
-    
+    return apply_filters(df, Filt(lambda data: np.asarray(filt(pd.Series(data)))), columns)
+
 def filt_3sigma(df, columns=[1], sig=3):
     """Retruns df with values greater than sig(3) sigma removed based on columns"""
-    def filt(data):
-        """Returns list of sig sigma filtered indices"""
-        av = data.mean()
-        sd = data.std()
-        return np.abs(data-av) <= sig*sd
-    return filter_data(df, filt, columns)
+    return apply_filters(df, sigma(sig), columns)
 
 def filt_gt(df, columns=[0, 1], val=0):
     """Retrun df with nonpositive (those greater than val) values removed based on columns"""
-    def filt(data):
-        """Returns list of filtered indices"""
-        return data > val
-    return filter_data(df, filt, columns)
+    return apply_filters(df, gt(val), columns)
 
 def filt_lt(df, columns=[0, 1], val=0):
     """Retrun df with nonpositive (those greater than val) values removed based on columns"""
-    def filt(data):
-        """Returns list of filtered indices"""
-        return data < val
-    return filter_data(df, filt, columns)
+    return apply_filters(df, lt(val), columns)
 
 def filt_edge_percent(df, columns=[1], per=0.05):
     """Retruns df with values greater than per removed based on columns"""
-    def filt(data):
-        """Returns list of filtered indices removing outside %"""
-        av = data.mean()
-        return np.abs((data-av)/av) <= per
-    return filter_data(df, filt, columns)
\ No newline at end of file
+    return apply_filters(df, edge_pct(per), columns)
@@ -0,0 +1,87 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from . import db_tools
+
+
+class AsyncDB(object):
+    """asyncio front end for db_tools.
+
+    pyodbc has no async driver, so every call runs the sync db_tools function
+    (on its pooled connection) in a thread pool. At most max_concurrency calls
+    run at once, each is bounded by timeout seconds, and awaiting tasks can be
+    cancelled. A timed out or cancelled call stops being awaited but the
+    statement already sent to the server still finishes in its thread.
+
+    Use it like this:
+
+    adb = AsyncDB(max_concurrency=8)
+    frames = await adb.map(adb.get_wafer_trimdata, wafers)
+
+    Keep db_pool size >= max_concurrency or calls wait for a connection.
+
+    Attributes:
+        max_concurrency (int): calls running at once.
+        timeout (float): default seconds per call, None for no limit.
+    """
+
+    def __init__(self, max_concurrency=8, timeout=30, executor=None):
+        """
+        Args:
+            max_concurrency (:obj:`int`, optional): calls running at once.
+            timeout (:obj:`float`, optional): default seconds per call.
+            executor (:obj:`Executor`, optional): default a ThreadPoolExecutor of max_concurrency.
+        """
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self._own_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers=max_concurrency,
+                                                       thread_name_prefix='fpy-db')
+        self._semaphore = None
+
+    async def run(self, func, *args, timeout=None, **kwargs):
+        """Await func(*args, **kwargs) in the executor, raises asyncio.TimeoutError past timeout"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            fut = loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+            return await asyncio.wait_for(fut, timeout if timeout is not None else self.timeout)
+
+    async def map(self, func, items, return_exceptions=True):
+        """Await func(item) for every item concurrently, results in order.
+        With return_exceptions a failed item gives its exception instead of stopping the rest.
+        """
+        return await asyncio.gather(*[func(item) for item in items], return_exceptions=return_exceptions)
+
+    async def get_trimdata(self, waferids, **kwargs):
+        return await self.run(db_tools.get_trimdata, waferids, **kwargs)
+
+    async def get_wafer_trimdata(self, waferid, **kwargs):
+        return await self.run(db_tools.get_wafer_trimdata, waferid, **kwargs)
+
+    async def get_wafer_info(self, waferid, **kwargs):
+        return await self.run(db_tools.get_wafer_info, waferid, **kwargs)
+
+    async def insert_ibe(self, wafer, run, a, b, c, **kwargs):
+        return await self.run(db_tools.insert_ibe, wafer, run, a, b, c, **kwargs)
+
+    async def overwrite_ibe(self, wafer, run, a, b, c, **kwargs):
+        return await self.run(db_tools.overwrite_ibe, wafer, run, a, b, c, **kwargs)
+
+    async def update_ibe(self, wafer, run, m, n, rsqd, **kwargs):
+        return await self.run(db_tools.update_ibe, wafer, run, m, n, rsqd, **kwargs)
+
+    async def upsert_ibe(self, records, **kwargs):
+        return await self.run(db_tools.upsert_ibe, records, **kwargs)
+
+    def close(self):
+        """Shut down the executor if AsyncDB made it"""
+        if self._own_executor:
+            self.executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
@@ -0,0 +1,190 @@
+import os
+import queue
+import sqlite3
+import threading
+import contextlib
+import configparser
+try:
+    import pyodbc
+except ImportError:  # offline, only the sqlite stand-in works
+    pyodbc = None
+
+DEFAULT_DSN = ("Driver={ODBC Driver 17 for SQL Server};"
+               "Server=rdm0sql01;"
+               "Database=MES_af;"
+               "Uid=austin;"
+               "Pwd=Test;")
+               #"Trusted_Connection=yes;")
+
+def find_dsn(config_file=None):
+    """
+    function find_dsn: (os.path) -> string
+
+    returns:
+        ODBC connection string from $FPY_DB_DSN, the [db] dsn of
+        config_file (default ~/.fpy.ini) or DEFAULT_DSN
+    """
+    dsn = os.environ.get('FPY_DB_DSN')
+    if dsn:
+        return dsn
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(config_file or os.path.join(os.path.expanduser('~'), '.fpy.ini'))
+    return config.get('db', 'dsn', fallback=DEFAULT_DSN)
+
+
+class ConnectionPool(object):
+    """Pool of reusable database connections.
+
+    Connections are opened lazily up to size, checked with a cheap query
+    when taken from the pool and replaced if dead. Use a session, which
+    commits on success, rolls back on error and returns the connection:
+
+    pool = ConnectionPool(size=4)
+    with pool.session() as cnxn:
+        df = pd.read_sql(sql, cnxn)
+
+    backend='sqlite' gives an offline stand-in; database=':memory:' is one
+    in-memory database shared by every connection of the pool.
+
+    Attributes:
+        backend (str): 'odbc' or 'sqlite'.
+        size (int): max open connections.
+        timeout (float): seconds to wait for a free connection.
+    """
+
+    def __init__(self, backend='odbc', dsn=None, database=':memory:', size=4, timeout=30,
+                 health_check='SELECT 1'):
+        """
+        Args:
+            backend (:obj:`str`, optional): 'odbc' (pyodbc) or 'sqlite'.
+            dsn (:obj:`str`, optional): ODBC connection string, default find_dsn().
+            database (:obj:`str`, optional): sqlite file or ':memory:'.
+            size (:obj:`int`, optional): max open connections.
+            timeout (:obj:`float`, optional): seconds to wait for a free connection.
+            health_check (:obj:`str`, optional): sql run on checkout, None to skip.
+        """
+        if backend not in ['odbc', 'sqlite']:
+            raise ValueError('backend must be "odbc" or "sqlite"')
+        self.backend = backend
+        self.dsn = dsn
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.health_check = health_check
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+        self._keep = None
+        if backend == 'sqlite' and database == ':memory:':
+            # one named in-memory db, alive while the pool holds a connection to it
+            self.database = 'file:fpy_pool_%d?mode=memory&cache=shared' % id(self)
+            self._keep = self.connect()
+
+    def connect(self):
+        """Open a new raw connection"""
+        if self.backend == 'sqlite':
+            return sqlite3.connect(self.database, uri=self.database.startswith('file:'),
+                                   check_same_thread=False)
+        if pyodbc is None:
+            raise ImportError('pyodbc is required for the odbc backend')
+        return pyodbc.connect(self.dsn or find_dsn())
+
+    def _healthy(self, cnxn):
+        if not self.health_check:
+            return True
+        try:
+            cnxn.cursor().execute(self.health_check).fetchall()
+            return True
+        except Exception:
+            return False
+
+    def _close(self, cnxn):
+        with self._lock:
+            self._opened -= 1
+        try:
+            cnxn.close()
+        except Exception:
+            pass
+
+    def acquire(self):
+        """Return a healthy connection, opening one if under size"""
+        while True:
+            try:
+                cnxn = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    can_open = self._opened < self.size
+                    if can_open:
+                        self._opened += 1
+                if can_open:
+                    try:
+                        return self.connect()
+                    except Exception:
+                        with self._lock:
+                            self._opened -= 1
+                        raise
+                try:
+                    cnxn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise TimeoutError('No free connection after %s s' % self.timeout)
+            if self._healthy(cnxn):
+                return cnxn
+            self._close(cnxn)
+
+    def release(self, cnxn):
+        """Return connection to the pool"""
+        self._idle.put(cnxn)
+
+    @contextlib.contextmanager
+    def session(self):
+        """Context manager yielding a pooled connection, commit or rollback on exit"""
+        cnxn = self.acquire()
+        try:
+            yield cnxn
+            cnxn.commit()
+        except BaseException:
+            # also GeneratorExit, when a streaming generator is closed early
+            try:
+                cnxn.rollback()
+            except Exception:
+                self._close(cnxn)
+                raise
+            self.release(cnxn)
+            raise
+        self.release(cnxn)
+
+    def close(self):
+        """Close all idle connections"""
+        while True:
+            try:
+                self._close(self._idle.get_nowait())
+            except queue.Empty:
+                break
+        if self._keep is not None:
+            self._keep.close()
+            self._keep = None
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def configure_pool(**kwargs):
+    """Replace the shared pool, kwargs as ConnectionPool. Returns the pool"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+        _pool = ConnectionPool(**kwargs)
+    return _pool
+
+def get_pool():
+    """Return the shared pool, created on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool()
+    return _pool
+
+def session():
+    """Session on the shared pool (see ConnectionPool.session)"""
+    return get_pool().session()
@@ -1,66 +1,173 @@
-import pyodbc 
+import os
+import re
+import pickle
+import decimal
+import numpy as np
 import pandas as pd
-from datetime import datetime
+from datetime import datetime, date
 from pytz import timezone
+from .db_pool import get_pool, session
+from .file_cache import atomic_write
 
 def db_connect():
-    cnxn = pyodbc.connect("Driver={ODBC Driver 17 for SQL Server};"
-                          "Server=rdm0sql01;"
-                          "Database=MES_af;"
-                          "Uid=austin;"
-                          "Pwd=Test;")
-                          #"Trusted_Connection=yes;")
-    return cnxn
+    """Return a new (unpooled) connection, prefer session()"""
+    return get_pool().connect()
 
+def table(name):
+    """Return the full table name for the pool backend ([MES_af].[dbo].[name] or [name])"""
+    if get_pool().backend == 'sqlite':
+        return '[%s]' % name
+    return '[MES_af].[dbo].[%s]' % name
 
-def get_wafer_trimdata(waferid):
 
-    cnxn = db_connect()
-    sql = (
-        "SELECT "
-        " IonTrim.[id]"
-        ",IonTrim.[fk_wafer]"
-        ",Wafers.Frequency"
-        ",IonTrim.[run]"
-        ",IonTrim.[a]"
-        ",IonTrim.[b]"
-        ",IonTrim.[c]"
-        ",IonTrim.[m]"
-        ",IonTrim.[n]"
-        ",IonTrim.[rsqd]"
-        ",IonTrim.[created]"
-        ",IonTrim.[updated]"
-        "FROM [MES_af].[dbo].[IonTrim] INNER JOIN [MES_af].[dbo].[Wafers] "
-        "ON IonTrim.fk_wafer = Wafers.id AND IonTrim.fk_wafer = '%s'" % waferid)
-
-    df = pd.read_sql(sql, cnxn)
-    return df
+TRIM_COLUMNS = [('id', 'int64'), ('fk_wafer', 'string'), ('Frequency', 'string'), ('run', 'Int64'),
+                ('a', 'float64'), ('b', 'float64'), ('c', 'float64'),
+                ('m', 'float64'), ('n', 'float64'), ('rsqd', 'float64'),
+                ('created', 'datetime'), ('updated', 'datetime')]
+
+def _wall_clock(values):
+    """Return naive datetime64 Series of values, Pacific wall clock like SQL Server stores them
+    (tz aware values, e.g. offset strings on the sqlite stand-in, are converted to US/Pacific)"""
+    def naive(ts):
+        if ts is None or ts is pd.NaT:
+            return pd.NaT
+        ts = pd.Timestamp(ts)
+        return ts.tz_convert('US/Pacific').tz_localize(None) if ts.tzinfo is not None else ts
+    try:
+        out = pd.to_datetime(pd.Series(values, dtype=object))
+    except (ValueError, TypeError):
+        # mixed offsets or naive and aware together
+        return pd.to_datetime(pd.Series([naive(v) for v in values], dtype=object))
+    if out.dt.tz is not None:
+        out = out.dt.tz_convert('US/Pacific').dt.tz_localize(None)
+    return out
+
+def _typed_frame(rows, columns):
+    """Return dataframe built column by column from cursor rows with dtypes from columns [(name, dtype)]"""
+    data = {}
+    for ii, (name, dtype) in enumerate(columns):
+        values = [row[ii] for row in rows]
+        if dtype == 'float64':
+            data[name] = np.array(values, dtype=np.float64)  # None --> nan
+        elif dtype == 'int64':
+            data[name] = np.array(values, dtype=np.int64)
+        elif dtype == 'datetime':
+            data[name] = _wall_clock(values)
+        elif dtype == 'string':
+            data[name] = pd.array([None if v is None else str(v) for v in values], dtype='string')
+        else:
+            data[name] = pd.array(values, dtype=dtype)
+    return pd.DataFrame(data, columns=[name for name, _ in columns])
+
+def _trim_cache_path(cache_dir, waferid):
+    return os.path.join(cache_dir, 'trim_%s.pkl' % re.sub(r'[^\w-]', '_', str(waferid)))
+
+def _trim_stamps(cursor, waferids):
+    """Return {fk_wafer: (count, max created, max updated)} for waferids"""
+    sql = ('SELECT [fk_wafer], COUNT(*), MAX([created]), MAX([updated]) FROM %s '
+           'WHERE [fk_wafer] IN (%s) GROUP BY [fk_wafer]' % (table('IonTrim'), ', '.join('?' * len(waferids))))
+    cursor.execute(sql, list(waferids))
+    return {str(w): (int(n), str(c), str(u)) for w, n, c, u in cursor.fetchall()}
+
+def get_trimdata(waferids, chunk_size=500, cache=True, cache_dir=None):
+    """Return IonTrim rows (joined with Wafers.Frequency) of many wafers with typed columns.
+    Wafers are fetched with a parameterized IN (...) query, one round trip per chunk.
+     Args:
+        waferids (list): wafer ids.
+        chunk_size (:obj:`int`, optional): wafers per query.
+        cache (:obj:`bool`, :obj:`str`, optional): True reads through a local cache checked
+            against each wafer's row count and latest created/updated (one small query),
+            'trust' uses cached wafers without asking the database, False skips the cache.
+        cache_dir (:obj:`str`, optional): default ~/.cache/fpy/trimdata.
+    """
+    waferids = [str(w) for w in dict.fromkeys(waferids)]
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'fpy', 'trimdata')
+    frames = []
+    todo = waferids
+    with session() as cnxn:
+        cursor = cnxn.cursor()
+        if cache:
+            cached = {}
+            for waferid in waferids:
+                try:
+                    with open(_trim_cache_path(cache_dir, waferid), 'rb') as f:
+                        cached[waferid] = pickle.load(f)
+                except (OSError, pickle.UnpicklingError, EOFError):
+                    pass
+            stamps = {}
+            if cache != 'trust':
+                for start in range(0, len(waferids), chunk_size):
+                    stamps.update(_trim_stamps(cursor, waferids[start:start + chunk_size]))
+            todo = []
+            for waferid in waferids:
+                if waferid in cached and (cache == 'trust' or cached[waferid][0] == stamps.get(waferid)):
+                    frames.append(cached[waferid][1])
+                else:
+                    todo.append(waferid)
+        for start in range(0, len(todo), chunk_size):
+            chunk = todo[start:start + chunk_size]
+            sql = (
+                "SELECT "
+                " IonTrim.[id]"
+                ",IonTrim.[fk_wafer]"
+                ",Wafers.Frequency"
+                ",IonTrim.[run]"
+                ",IonTrim.[a]"
+                ",IonTrim.[b]"
+                ",IonTrim.[c]"
+                ",IonTrim.[m]"
+                ",IonTrim.[n]"
+                ",IonTrim.[rsqd]"
+                ",IonTrim.[created]"
+                ",IonTrim.[updated] "
+                "FROM %s AS IonTrim INNER JOIN %s AS Wafers "
+                "ON IonTrim.fk_wafer = Wafers.id "
+                "WHERE IonTrim.fk_wafer IN (%s)" % (table('IonTrim'), table('Wafers'), ', '.join('?' * len(chunk))))
+            cursor.execute(sql, chunk)
+            df = _typed_frame(cursor.fetchall(), TRIM_COLUMNS)
+            frames.append(df)
+            if cache:
+                os.makedirs(cache_dir, exist_ok=True)
+                for waferid in chunk:
+                    if waferid not in stamps and cache != 'trust':
+                        continue  # no rows yet, nothing worth caching
+                    with atomic_write(_trim_cache_path(cache_dir, waferid)) as tmp:
+                        with open(tmp, 'wb') as f:
+                            pickle.dump((stamps.get(waferid), df[df['fk_wafer'] == waferid].reset_index(drop=True)), f)
+    if not frames:
+        return _typed_frame([], TRIM_COLUMNS)
+    df = pd.concat(frames, ignore_index=True)
+    # back in the order asked for
+    order = df['fk_wafer'].map({w: ii for ii, w in enumerate(waferids)}).to_numpy(dtype=float)
+    return df.take(np.argsort(order, kind='stable')).reset_index(drop=True)
+
+def get_wafer_trimdata(waferid, cache=False):
+    """Return IonTrim rows of one wafer (see get_trimdata)"""
+    return get_trimdata([waferid], cache=cache)
 
 def get_wafer_info(waferid):
-    
-    cnxn = db_connect()
-    cursor = cnxn.cursor()
 
     sql = (
             "SELECT "
             "WaferID, "
             "D8Number, "
             "Frequency "
-            "FROM [MES_af].[dbo].[Wafers] "
-            "WHERE WaferID = ?")
-
+            "FROM %s "
+            "WHERE WaferID = ?" % table('Wafers'))
 
-    cursor.execute(sql, waferid)
-    for row in cursor.fetchall():
+    with session() as cnxn:
+        cursor = cnxn.cursor()
+        cursor.execute(sql, (waferid,))
+        rows = cursor.fetchall()
+    for row in rows:
         print(row)
+    return rows
 
 
 def insert_ibe (wafer, run, a, b, c):
-    cnxn = db_connect()
-    cursor = cnxn.cursor()
-
     sql = (
-        'INSERT INTO [MES_af].[dbo].[IonTrim] ('
+        'INSERT INTO %s ('
         '[fk_wafer]'
         ',[run]'
         ',[a]'
@@ -70,44 +177,303 @@ def insert_ibe (wafer, run, a, b, c):
         ',[n]'
         ',[rsqd]'
         ',[created]'
-        ',[updated])'
-        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)')
+        ',[updated]) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)' % table('IonTrim'))
     values = (wafer, run, a, b, c, None, None, None, datetime.now(timezone('US/Pacific')), None)
-    cursor.execute(sql, values)
-    cnxn.commit()
+    with session() as cnxn:
+        cnxn.cursor().execute(sql, values)
 
 def overwrite_ibe(wafer, run, a, b, c):
-    cnxn = db_connect()
-    cursor = cnxn.cursor()
-
     sql = (
-        'UPDATE [MES_af].[dbo].[IonTrim] ' 
+        'UPDATE %s ' 
         'SET '
         '[a] = ?, '
         '[b] = ?, '
         '[c] = ?, '
         '[created] = ? '
         'WHERE '
-        '[fk_wafer] = ? AND'
-        '[run] = ?')
+        '[fk_wafer] = ? AND '
+        '[run] = ?' % table('IonTrim'))
     values = (a, b, c, datetime.now(timezone('US/Pacific')), wafer, run)
-    cursor.execute(sql, values)
-    cnxn.commit()
+    with session() as cnxn:
+        cnxn.cursor().execute(sql, values)
     
 def update_ibe(wafer, run, m, n, rsqd):
-    cnxn = db_connect()
-    cursor = cnxn.cursor()
-
     sql = (
-        'UPDATE [MES_af].[dbo].[IonTrim] ' 
+        'UPDATE %s ' 
         'SET '
         '[m] = ?, '
         '[n] = ?, '
         '[rsqd] = ?, '
         '[updated] = ? '
         'WHERE '
-        '[fk_wafer] = ? AND'
-        '[run] = ?')
+        '[fk_wafer] = ? AND '
+        '[run] = ?' % table('IonTrim'))
     values = (m, n, rsqd, datetime.now(timezone('US/Pacific')), wafer, run)
-    cursor.execute(sql, values)
-    cnxn.commit()
\ No newline at end of file
+    with session() as cnxn:
+        cnxn.cursor().execute(sql, values)
+
+IBE_VALUE_COLUMNS = {'a': 'created', 'b': 'created', 'c': 'created',
+                     'm': 'updated', 'n': 'updated', 'rsqd': 'updated'}  # column: timestamp it stamps
+
+def _ibe_records(records):
+    """Return list of dicts from a dataframe or iterable of dicts (wafer --> fk_wafer, NaN --> None)"""
+    if isinstance(records, pd.DataFrame):
+        records = records.astype(object).where(records.notna(), None).to_dict('records')
+    out = []
+    for rec in records:
+        rec = dict(rec)
+        if 'fk_wafer' not in rec and 'wafer' in rec:
+            rec['fk_wafer'] = rec.pop('wafer')
+        out.append(rec)
+    return out
+
+def upsert_ibe(records, chunk_size=500):
+    """Insert or update many IonTrim rows keyed on (fk_wafer, run), MERGE style.
+    Existing rows get the given value columns updated (a, b, c stamp created;
+    m, n, rsqd stamp updated like overwrite_ibe and update_ibe), new rows are inserted.
+    Each chunk is one transaction written with executemany (fast_executemany on pyodbc);
+    a failing chunk is rolled back and its rows reported as errors. The existing keys are
+    read WITH (UPDLOCK, HOLDLOCK) (BEGIN IMMEDIATE on sqlite) so concurrent writers queue
+    on the chunk instead of inserting the same (fk_wafer, run) twice.
+     Args:
+        records (pd.dataframe, iterable): rows with fk_wafer (or wafer), run and any of
+            a, b, c, m, n, rsqd.
+        chunk_size (:obj:`int`, optional): rows per transaction.
+    Returns:
+        pd.dataframe: fk_wafer, run, outcome ('inserted', 'updated', 'unchanged' (existing row,
+            no value columns given), 'duplicate', 'error') and error.
+    """
+    records = _ibe_records(records)
+    outcomes = [None] * len(records)
+    # last record of a key wins
+    last = {}
+    for ii, rec in enumerate(records):
+        key = (rec['fk_wafer'], rec['run'])
+        if key in last:
+            outcomes[last[key]] = ('duplicate', None)
+        last[key] = ii
+    todo = sorted(last.values())
+    now = datetime.now(timezone('US/Pacific'))
+    for start in range(0, len(todo), chunk_size):
+        chunk = todo[start:start + chunk_size]
+        try:
+            with session() as cnxn:
+                cursor = cnxn.cursor()
+                if hasattr(cursor, 'fast_executemany'):
+                    cursor.fast_executemany = True
+                if get_pool().backend == 'sqlite':
+                    # take the write lock before reading the keys
+                    cursor.execute('BEGIN IMMEDIATE')
+                    hint = ''
+                else:
+                    # hold the key range until commit, like MERGE ... WITH (HOLDLOCK)
+                    hint = ' WITH (UPDLOCK, HOLDLOCK)'
+                wafers = sorted({records[ii]['fk_wafer'] for ii in chunk}, key=str)
+                sql = ('SELECT [fk_wafer], [run] FROM %s%s WHERE [fk_wafer] IN (%s)'
+                       % (table('IonTrim'), hint, ', '.join('?' * len(wafers))))
+                cursor.execute(sql, wafers)
+                existing = {(str(w), int(r)) for w, r in cursor.fetchall()}
+                inserts = []
+                unchanged = []
+                updates = {}  # value columns: rows
+                for ii in chunk:
+                    rec = records[ii]
+                    cols = tuple(c for c in IBE_VALUE_COLUMNS if c in rec)
+                    if (str(rec['fk_wafer']), int(rec['run'])) not in existing:
+                        inserts.append(ii)
+                    elif cols:
+                        updates.setdefault(cols, []).append(ii)
+                    else:
+                        unchanged.append(ii)
+                if inserts:
+                    sql = ('INSERT INTO %s ([fk_wafer], [run], [a], [b], [c], [m], [n], [rsqd], [created], [updated]) '
+                           'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)' % table('IonTrim'))
+                    cursor.executemany(sql, [
+                        [records[ii]['fk_wafer'], records[ii]['run']] +
+                        [records[ii].get(c) for c in IBE_VALUE_COLUMNS] +
+                        [now, now if any(records[ii].get(c) is not None for c in ['m', 'n', 'rsqd']) else None]
+                        for ii in inserts])
+                for cols, rows in updates.items():
+                    stamps = sorted({IBE_VALUE_COLUMNS[c] for c in cols})
+                    sets = ', '.join('[%s] = ?' % c for c in list(cols) + stamps)
+                    sql = 'UPDATE %s SET %s WHERE [fk_wafer] = ? AND [run] = ?' % (table('IonTrim'), sets)
+                    cursor.executemany(sql, [
+                        [records[ii][c] for c in cols] + [now] * len(stamps) +
+                        [records[ii]['fk_wafer'], records[ii]['run']]
+                        for ii in rows])
+        except Exception as e:
+            for ii in chunk:
+                outcomes[ii] = ('error', str(e))
+            continue
+        for ii in inserts:
+            outcomes[ii] = ('inserted', None)
+        for ii in unchanged:
+            outcomes[ii] = ('unchanged', None)
+        for rows in updates.values():
+            for ii in rows:
+                outcomes[ii] = ('updated', None)
+    return pd.DataFrame([(rec.get('fk_wafer'), rec.get('run')) + out for rec, out in zip(records, outcomes)],
+                        columns=['fk_wafer', 'run', 'outcome', 'error'])
+
+
+# pyodbc reports the precision of integer columns: tinyint 3, smallint 5, int 10, bigint 19
+_INT_DTYPES = [(3, 'uint8', 'UInt8'), (5, 'int16', 'Int16'), (10, 'int32', 'Int32'), (19, 'int64', 'Int64')]
+
+def _odbc_dtype(desc, float32=False):
+    """Return pandas dtype for a pyodbc cursor.description entry"""
+    type_code, precision, null_ok = desc[1], desc[4], desc[6]
+    if type_code is bool:
+        return 'boolean' if null_ok else 'bool'
+    if type_code is int:
+        for digits, dtype, nullable in _INT_DTYPES:
+            if precision is not None and precision <= digits:
+                return nullable if null_ok else dtype
+        return 'Int64' if null_ok else 'int64'
+    if type_code is float:
+        # sql real (precision 24) is float32 already
+        return 'float32' if float32 or (precision is not None and precision <= 24) else 'float64'
+    if type_code is decimal.Decimal:
+        return 'float32' if float32 else 'float64'
+    if type_code in (datetime, date):
+        return 'datetime64[ns]'
+    return object
+
+def _declared_dtype(decl, float32=False):
+    """Return pandas dtype for a sqlite declared column type (sqlite type affinity)"""
+    decl = (decl or '').upper()
+    if 'INT' in decl:
+        return 'Int64'
+    if any(t in decl for t in ('REAL', 'FLOA', 'DOUB')):
+        return 'float32' if float32 else 'float64'
+    return object
+
+def _first_chunk_dtype(series, float32=False):
+    """Return dtype for a column with no type information, from the first chunk
+    (ints with NULLs are read as floats, they stay float64: exact below 2**53)"""
+    if series.isna().all():
+        return object
+    if not pd.api.types.is_numeric_dtype(series.dtype) and not pd.api.types.is_bool_dtype(series.dtype):
+        try:
+            series = pd.to_numeric(series)
+        except (ValueError, TypeError):
+            return object
+    if pd.api.types.is_bool_dtype(series.dtype):
+        return 'boolean'
+    if pd.api.types.is_integer_dtype(series.dtype):
+        return 'Int64'
+    if pd.api.types.is_float_dtype(series.dtype):
+        return 'float32' if float32 else 'float64'
+    return object
+
+def _stream_schema(description, first, float32=False, schema=None):
+    """Return {column: dtype} fixed for every chunk of a stream.
+    From cursor.description type codes (pyodbc), else the first chunk; schema overrides both.
+    """
+    dtypes = {}
+    for desc in description:
+        col = desc[0]
+        dtypes[col] = _odbc_dtype(desc, float32) if desc[1] is not None else _first_chunk_dtype(first[col], float32)
+    if schema:
+        dtypes.update((col, dtype) for col, dtype in schema.items() if col in first.columns)
+    return dtypes
+
+def iter_query(sql, params=(), chunk_size=10000, downcast=True, arrow=False, float32=False, schema=None):
+    """Yield the result of sql in chunks of chunk_size rows (cursor.fetchmany).
+    The pooled connection is held until the generator is exhausted or closed.
+    Every chunk gets the same dtypes: from the column types of cursor.description
+    (ints sized by their sql type, nullable Int/boolean where the column allows NULL,
+    text as object), or the first chunk when the driver gives no types (sqlite);
+    columns that are all NULL in that first chunk are object.
+     Args:
+        sql (str): query, ? placeholders for params.
+        params (:obj:`list`, optional): query parameters.
+        chunk_size (:obj:`int`, optional): rows per chunk.
+        downcast (:obj:`bool`, optional): apply the (lossless) column dtypes.
+        arrow (:obj:`bool`, optional): yield pyarrow.RecordBatch (one schema) instead of dataframes.
+        float32 (:obj:`bool`, optional): float columns as float32 (loses precision).
+        schema (:obj:`dict`, optional): {column: dtype} overriding the derived dtypes.
+    """
+    if arrow:
+        import pyarrow as pa
+    with session() as cnxn:
+        cursor = cnxn.cursor()
+        cursor.execute(sql, list(params))
+        description = cursor.description
+        columns = [d[0] for d in description]
+        dtypes = None
+        arrow_schema = None
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            df = pd.DataFrame.from_records([tuple(row) for row in rows], columns=columns)
+            if downcast:
+                if dtypes is None:
+                    dtypes = _stream_schema(description, df, float32, schema)
+                df = df.astype(dtypes)
+            if not arrow:
+                yield df
+                continue
+            if arrow_schema is None:
+                arrow_schema = pa.Schema.from_pandas(df, preserve_index=False)
+                # all NULL first: a type later rows can fill
+                for ii, field in enumerate(arrow_schema):
+                    if pa.types.is_null(field.type):
+                        arrow_schema = arrow_schema.set(ii, field.with_type(pa.string()))
+                arrow_schema = arrow_schema.remove_metadata()
+            yield pa.RecordBatch.from_pandas(df, schema=arrow_schema, preserve_index=False)
+
+def _hwm_path(name, hwm_dir=None):
+    if hwm_dir is None:
+        hwm_dir = os.path.join(os.path.expanduser('~'), '.cache', 'fpy', 'hwm')
+    os.makedirs(hwm_dir, exist_ok=True)
+    return os.path.join(hwm_dir, '%s.txt' % re.sub(r'[^\w-]', '_', name))
+
+def _as_datetime(value):
+    """Return value as datetime (sqlite gives the stamps back as ISO text)"""
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(str(value))
+
+def iter_table(name, columns='*', chunk_size=10000, downcast=True, arrow=False,
+               incremental=False, hwm_dir=None, float32=False, schema=None):
+    """Yield chunks of a whole table (IonTrim, Status, ...), see iter_query.
+    With incremental=True only rows whose updated or created is later than the stored
+    high-water mark are fetched (overwrite_ibe re-stamps created and keeps an older updated),
+    and the mark, the latest of both stamps kept as ISO-8601, is moved once all chunks have
+    been read.
+     Args:
+        name (str): table name.
+        columns (:obj:`str`, optional): sql column list.
+        incremental (:obj:`bool`, optional): only rows changed since the last full read.
+        hwm_dir (:obj:`str`, optional): where marks are kept, default ~/.cache/fpy/hwm.
+        float32, schema: see iter_query.
+    """
+    sql = 'SELECT %s FROM %s' % (columns, table(name))
+    params = []
+    if incremental:
+        path = _hwm_path(name, hwm_dir)
+        hwm = open(path).read().strip() if os.path.exists(path) else None
+        if hwm:
+            hwm = _as_datetime(hwm)
+            sql += ' WHERE [updated] > ? OR [created] > ?'
+            params += [hwm, hwm]
+        # mark from the same snapshot as the rows, read before them
+        with session() as cnxn:
+            cursor = cnxn.cursor()
+            cursor.execute('SELECT MAX([updated]), MAX([created]) FROM %s' % table(name))
+            stamps = [_as_datetime(v) for v in cursor.fetchone() if v is not None]
+        new_hwm = max(stamps) if stamps else None
+    if downcast and get_pool().backend == 'sqlite':
+        # sqlite gives no column types with the rows, use the declared ones
+        with session() as cnxn:
+            info = cnxn.cursor().execute('PRAGMA table_info(%s)' % table(name)).fetchall()
+        declared = {row[1]: _declared_dtype(row[2], float32) for row in info}
+        schema = dict(declared, **(schema or {}))
+    for chunk in iter_query(sql, params, chunk_size, downcast, arrow, float32, schema):
+        yield chunk
+    if incremental and new_hwm is not None:
+        with atomic_write(path) as tmp:
+            with open(tmp, 'w') as f:
+                f.write(new_hwm.isoformat())
@@ -0,0 +1,135 @@
+import os
+import re
+import time
+import functools
+import threading
+
+
+@functools.lru_cache(maxsize=256)
+def compile_pattern(pattern, flags=0):
+    """Return compiled regex, compiled once per pattern"""
+    return re.compile(pattern, flags)
+
+
+class DirIndex(object):
+    """In memory index of directory listings on the ptestbend share.
+
+    Every os.listdir on the SMB mount is a network round trip. DirIndex keeps
+    the os.scandir entries of each directory it has seen and answers repeat
+    lookups from memory. By default (ttl=0) every lookup checks the directory
+    mtime (one stat, much cheaper than a listing) and the listing is only
+    re-read if the directory changed, so a new run shows up straight away.
+    A ttl > 0 trusts a listing for that many seconds without the stat, only
+    use it for a bulk pass over directories that are not being written to.
+
+    Use it like this:
+
+    dir_index.walk(os.path.join(find_base_path(), '1090'), depth=3)  # prefetch a freq
+    names = dir_index.listdir(full_path)
+    runs = dir_index.match(full_path, r'\d{4,5}-p\d-\d\d')
+    dir_index.refresh(full_path)  # force re-read
+
+    Attributes:
+        ttl (float): seconds a listing is trusted without a stat (0, always check).
+        check_mtime (bool): revalidate expired listings by directory mtime.
+        hits (int): lookups answered from memory.
+        misses (int): lookups that had to list the directory.
+    """
+
+    def __init__(self, ttl=0, check_mtime=True):
+        """
+        Args:
+            ttl (:obj:`float`, optional): seconds a listing is trusted without a stat.
+            check_mtime (:obj:`bool`, optional): revalidate expired listings by mtime.
+        """
+        self.ttl = ttl
+        self.check_mtime = check_mtime
+        self.hits = 0
+        self.misses = 0
+        self._dirs = {}  # path: (checked time, dir mtime, {name: is_dir})
+        self._lock = threading.Lock()
+
+    def _scan(self, path):
+        """List path with os.scandir and store it (a miss), returns {name: is_dir}"""
+        mtime = os.stat(path).st_mtime
+        with os.scandir(path) as it:
+            entries = {}
+            for entry in it:
+                try:
+                    entries[entry.name] = entry.is_dir()
+                except OSError:
+                    entries[entry.name] = False
+        with self._lock:
+            self._dirs[path] = (time.monotonic(), mtime, entries)
+            self.misses += 1
+        return entries
+
+    def entries(self, path):
+        """Return {name: is_dir} for path from the index (listing it if needed)"""
+        path = os.path.normpath(path)
+        with self._lock:
+            cached = self._dirs.get(path)
+        if cached is not None:
+            checked, mtime, entries = cached
+            if time.monotonic() - checked < self.ttl:
+                with self._lock:
+                    self.hits += 1
+                return entries
+            if self.check_mtime:
+                try:
+                    unchanged = os.stat(path).st_mtime == mtime
+                except OSError:
+                    unchanged = False
+                if unchanged:
+                    with self._lock:
+                        self._dirs[path] = (time.monotonic(), mtime, entries)
+                        self.hits += 1
+                    return entries
+        return self._scan(path)
+
+    def listdir(self, path):
+        """Drop in for os.listdir"""
+        return list(self.entries(path))
+
+    def isdir(self, path):
+        """Drop in for os.path.isdir, answered from the parent listing when indexed"""
+        parent, name = os.path.split(os.path.normpath(path))
+        try:
+            return self.entries(parent).get(name, False)
+        except OSError:
+            return False
+
+    def match(self, path, pattern, flags=0):
+        """Return names in path matching regex pattern (re.match)"""
+        p = compile_pattern(pattern, flags)
+        return [name for name in self.entries(path) if p.match(name)]
+
+    def walk(self, root, depth=3):
+        """Index root and its sub directories depth levels down with one scandir each"""
+        todo = [(os.path.normpath(root), 0)]
+        while todo:
+            path, level = todo.pop()
+            try:
+                entries = self._scan(path)
+            except OSError:
+                continue
+            if level < depth:
+                todo.extend((os.path.join(path, name), level + 1)
+                            for name, is_dir in entries.items() if is_dir)
+
+    def refresh(self, path=None):
+        """Forget path and everything below it (everything if path is None)"""
+        with self._lock:
+            if path is None:
+                self._dirs.clear()
+                return
+            path = os.path.normpath(path)
+            for key in [k for k in self._dirs if k == path or k.startswith(path + os.sep)]:
+                del self._dirs[key]
+
+    def info(self):
+        """Return dict of hits, misses and number of directories indexed"""
+        return {'hits': self.hits, 'misses': self.misses, 'dirs': len(self._dirs)}
+
+# shared index used by file_funcs
+dir_index = DirIndex()
@@ -0,0 +1,219 @@
+import os
+import json
+import hashlib
+import tempfile
+import functools
+import contextlib
+import collections
+import pandas as pd
+try:
+    import pyarrow.feather as feather
+except ImportError:  # fall back to pickle when pyarrow is not installed
+    feather = None
+
+
+# mkstemp makes 0600 files, give the renamed files the usual umask permissions
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+@contextlib.contextmanager
+def atomic_write(path):
+    """Context manager yielding a temp file name next to path, renamed over path on success.
+    The temp name is unique (tempfile.mkstemp) so threads and kernels writing the same
+    path never share it, and readers never see half a file.
+
+    with atomic_write(path) as tmp:
+        df.to_pickle(tmp)
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                               prefix=os.path.basename(path) + '.', suffix='.tmp')
+    os.close(fd)
+    try:
+        yield tmp
+        os.chmod(tmp, 0o666 & ~_UMASK)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def default_cache_dir():
+    """Return local cache dir ($FPY_CACHE_DIR or ~/.cache/fpy)"""
+    return os.environ.get('FPY_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'fpy'))
+
+
+class FileCache(object):
+    """Local on-disk cache of parsed test files (header dict + dataframe).
+
+    Entries are keyed by reader, absolute path, size, mtime and reader args so
+    a changed file on the share is re-parsed. Dataframes are stored as Feather
+    (memory mapped on load) when pyarrow is installed, else as pickle. The
+    header and namedtuple layout are stored in a .json sidecar whose mtime is
+    touched on every hit; when the cache grows past max_bytes the least
+    recently used ('lru') or oldest written ('fifo') entries are evicted.
+
+    Register a reader like this:
+
+    @file_cache.cached('.txt')
+    def read_waferview(fileName, ...):
+
+    and call it with cache=False to bypass or cache='refresh' to re-parse.
+
+    Attributes:
+        cache_dir (str): directory holding the entries.
+        max_bytes (int): size cap for all entries.
+        policy (str): 'lru' or 'fifo'.
+        hits (int): cache hits.
+        misses (int): cache misses.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=2*1024**3, policy='lru'):
+        """
+        Args:
+            cache_dir (:obj:`str`, optional): cache directory, default default_cache_dir().
+            max_bytes (:obj:`int`, optional): size cap in bytes (2 GB).
+            policy (:obj:`str`, optional): eviction policy 'lru' or 'fifo'.
+        """
+        if policy not in ['lru', 'fifo']:
+            raise ValueError('policy must be "lru" or "fifo"')
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        self.ext = '.feather' if feather else '.pkl'
+
+    def key(self, func, path, args, kwargs):
+        """Return cache key for func(path, *args, **kwargs) or None if path does not exist"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        raw = repr((func.__module__, func.__name__, os.path.abspath(path),
+                    st.st_size, st.st_mtime_ns, args, sorted(kwargs.items())))
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def _paths(self, key):
+        base = os.path.join(self.cache_dir, key)
+        return base + '.json', base + self.ext
+
+    def get(self, key):
+        """Return cached namedtuple for key or None"""
+        meta_path, data_path = self._paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if feather:
+                df = feather.read_feather(data_path, memory_map=True)
+            else:
+                df = pd.read_pickle(data_path)
+        except (OSError, ValueError):
+            return None
+        if self.policy == 'lru':
+            os.utime(meta_path)
+        Summary = collections.namedtuple(meta['name'], meta['fields'])
+        return Summary(meta['header'], df)
+
+    def put(self, key, summary):
+        """Store namedtuple(header, dataframe) under key then evict past max_bytes"""
+        header, df = summary
+        if header is None or not isinstance(df, pd.DataFrame):
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        meta_path, data_path = self._paths(key)
+        meta = {'name': type(summary).__name__, 'fields': list(summary._fields), 'header': header}
+        try:
+            meta_txt = json.dumps(meta)
+        except TypeError:
+            return  # header not json-able, do not cache
+        with atomic_write(data_path) as tmp:
+            if feather:
+                feather.write_feather(df, tmp)
+            else:
+                df.to_pickle(tmp)
+        with atomic_write(meta_path) as tmp:
+            with open(tmp, 'w') as f:
+                f.write(meta_txt)
+        self.evict()
+
+    def entries(self):
+        """Return list of (last used, bytes, key) for all entries"""
+        out = []
+        if not os.path.isdir(self.cache_dir):
+            return out
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith('.json'):
+                continue
+            key = entry.name[:-5]
+            meta_path, data_path = self._paths(key)
+            try:
+                size = entry.stat().st_size + os.path.getsize(data_path)
+            except OSError:
+                size = entry.stat().st_size
+            out.append((entry.stat().st_mtime, size, key))
+        return out
+
+    def size(self):
+        """Return total bytes used by the cache"""
+        return sum(e[1] for e in self.entries())
+
+    def remove(self, key):
+        """Remove one entry"""
+        for path in self._paths(key):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def evict(self):
+        """Remove least recently used entries until under max_bytes, returns number removed"""
+        entries = sorted(self.entries())
+        total = sum(e[1] for e in entries)
+        removed = 0
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            self.remove(key)
+            total -= size
+            removed += 1
+        return removed
+
+    def clear(self):
+        """Remove all entries"""
+        for _, _, key in self.entries():
+            self.remove(key)
+
+    def cached(self, ext):
+        """Decorator for reader(fileName, ...) that opens fileName + ext"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(fileName, *args, cache=True, **kwargs):
+                if not (cache and self.enabled):
+                    return func(fileName, *args, **kwargs)
+                key = self.key(func, fileName + ext, args, kwargs)
+                if key is None:
+                    return func(fileName, *args, **kwargs)
+                if cache == 'refresh':
+                    self.remove(key)
+                else:
+                    summary = self.get(key)
+                    if summary is not None:
+                        self.hits += 1
+                        return summary
+                self.misses += 1
+                summary = func(fileName, *args, **kwargs)
+                try:
+                    self.put(key, summary)
+                except (OSError, ValueError, TypeError) as e:
+                    print('not cached: %s' % e)
+                return summary
+            return wrapper
+        return decorator
+
+# shared cache used by the file_funcs readers
+file_cache = FileCache()
@@ -1,12 +1,16 @@
 import os
-import csv
+import mmap
 import platform
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from .either import Either
 import re
 import collections
 import pandas as pd
 import numpy as np
-from .basic_tools import user_input, filt_gt, filt_lt, filt_3sigma, filt_edge_percent
+from .basic_tools import user_input, apply_filters, gt, lt, sigma, edge_pct
+from .file_cache import file_cache, atomic_write
+from .dir_index import dir_index
 
 
 def find_base_path():
@@ -42,11 +46,9 @@ def find_test_path(base_path, freq, wafer, test_step, d8_num, test_spec):
     full_path = os.path.join(base_path, str(freq), str(wafer), test_step)
     # get test spec # # # # # # # # # # # # # # # # # # # # # # # # # # #
     if not test_spec:
-        files_list = os.listdir(full_path)
-        p = re.compile('.*' + re.escape(str(d8_num)))
-        files = list(filter(p.match, files_list))
+        files = dir_index.match(full_path, '.*' + re.escape(str(d8_num)))
         if not files:
-            raise ValueError('No test spec with "%s"\nFiles available: %s' % (str(d8_num), str(files_list)))
+            raise ValueError('No test spec with "%s"\nFiles available: %s' % (str(d8_num), str(dir_index.listdir(full_path))))
         elif len(files) > 1:
             raise ValueError('More than one test spec has been used for "%s"' % str(d8_num))
             
@@ -59,15 +61,14 @@ def find_test_path(base_path, freq, wafer, test_step, d8_num, test_spec):
 
 def get_filename(full_path, file_num):
     """get file name"""
-    files_list = os.listdir(full_path)
     if int(file_num) < 1:
-        p = re.compile('\d{4,5}-p\d-\d\d')
+        pattern = r'\d{4,5}-p\d-\d\d'
 
     else:
-        p = re.compile('\d{4,5}-p\d-' + str(file_num))
+        pattern = r'\d{4,5}-p\d-' + str(file_num)
         file_num = 0
         
-    fname = list(filter(p.match, files_list))
+    fname = dir_index.match(full_path, pattern)
     if len(fname) >= abs(int(file_num)):
         fname.sort(key = lambda x: x[-3:-1])
         fname = fname[int(file_num)]
@@ -98,7 +99,62 @@ def get_target_param(summary, test_step=None, target_param=None):
          raise ValueError('no matching comumn: "%s" ??' % target_param)
     return target_param
 
-def read_filmetrics(fileName):
+WAFERVIEW_DIE_COLUMNS = ['DieNum', 'DieX', 'DieY']
+
+COMPACT_PROFILES = {
+    # reader: int32 columns (die numbers/coordinates), float dtype of measurements,
+    # string columns to categorical
+    'waferview': {'int32': WAFERVIEW_DIE_COLUMNS, 'float': np.float32, 'category': True},
+    'filmetrics': {'int32': [], 'float': np.float32, 'category': True},
+    'cde': {'int32': [], 'float': np.float32, 'category': True},
+}
+
+def compact_frame(df, profile='waferview', report=False):
+    """Return df with the smaller dtypes of a COMPACT_PROFILES profile.
+    Profile int32 columns holding whole numbers become int32, other int64 columns int32
+    when in range, floats become the profile float and string columns categorical.
+    The fitting and plotting code (FitLinear, wafermap_grid) casts to float64 before doing
+    arithmetic, so compact frames do not overflow or lose precision there.
+     Args:
+        df (pd.dataframe): reader dataframe.
+        profile (:obj:`str`, dict): COMPACT_PROFILES key or profile dict.
+        report (:obj:`bool`, optional): also return (bytes before, bytes after).
+    """
+    if isinstance(profile, str):
+        profile = COMPACT_PROFILES[profile]
+    before = int(df.memory_usage(deep=True).sum()) if report else None
+    i32 = np.iinfo(np.int32)
+    dtypes = {}
+    for col in df.columns:
+        s = df[col]
+        kind = s.dtype.kind
+        if kind in 'iuf' and (col in profile['int32'] or kind in 'iu'):
+            v = s.to_numpy()
+            if (v.size == 0 or (np.isfinite(v).all() and (v == np.round(v)).all()
+                                and v.min() >= i32.min and v.max() <= i32.max)):
+                dtypes[col] = np.int32
+                continue
+        if kind == 'f':
+            dtypes[col] = profile['float']
+        elif kind == 'O' and profile['category'] and s.nunique() <= len(s)//2:
+            dtypes[col] = 'category'
+    if dtypes:
+        df = df.astype(dtypes)
+    if report:
+        return df, (before, int(df.memory_usage(deep=True).sum()))
+    return df
+
+def _compact(df, profile, name):
+    """compact_frame and print the memory saved"""
+    df, (before, after) = compact_frame(df, profile, report=True)
+    print('%s: %.2f MB -> %.2f MB' % (name, before/1e6, after/1e6))
+    return df
+
+@file_cache.cached('.txt')
+def read_filmetrics(fileName, compact=False):
+    """return named tuple with header and dataframe (3 sigma and 5% edge filtered thickness)
+    from Filmetrics file, compact=True applies COMPACT_PROFILES['filmetrics']
+    """
     FilmetricsSummary = collections.namedtuple('Filmetrics_File', ['header', 'dataframe'])
     with open(fileName + '.txt') as f:
         header = {}
@@ -116,111 +172,377 @@ def read_filmetrics(fileName):
         # get data into dataframe
         df = pd.read_csv(f, header=None, names=header['columns'], skipfooter=4, engine='python', quotechar='\"')
     # remove outliers from thickness    
-    df_filt = filt_edge_percent(filt_3sigma(df,['Site 1 Layer 1 Thickness (A)']), ['Site 1 Layer 1 Thickness (A)'])
-    return WaferViewSummary(header, df_filt)
+    df_filt = apply_filters(df, sigma(3) & edge_pct(0.05), ['Site 1 Layer 1 Thickness (A)'])
+    if compact:
+        df_filt = _compact(df_filt, 'filmetrics', fileName)
+    return FilmetricsSummary(header, df_filt)
 
-def read_CDE(filename):
+_CDE_FIELDS = re.compile(r'<([^>]*)>')
+_CDE_SPLIT = re.compile(r'(?:\t|  )+')
+
+@file_cache.cached('.RsM')
+def read_CDE(filename, compact=False):
+    """return named tuple with header and dataframe from CDE ResMap .RsM file
+    Header lines are "value\tvalue\t<name, name>", the "<Data, col, col>" line
+    starts the first data row; the data block is handed to the C parser.
+    compact=True applies COMPACT_PROFILES['cde'].
+    """
     CDESummary = collections.namedtuple('CDE_File', ['header', 'dataframe'])
+    header = {'FileName': filename,} # should be capture in files header but justincase
     with open(filename + '.RsM') as f:
-        header = {'FileName': filename,} # should be capture in files header but justincase
-        lines = [a for a in f]
-    for il, line in enumerate(lines):
-        while '  ' in line:
-            line = line.replace('  ', '\t')
-        sline = re.split(r'\t+', line)
-        if '<' in line:
-            cols = line[line.find('<') + 1:line.find('>')].split(',')
+        for line in iter(f.readline, ''):
+            fields = _CDE_FIELDS.search(line)
+            if not fields:
+                raise ValueError('This should not be.\nAll lines in header should include "<"')
+            # pairs of spaces count as a tab
+            cols = fields.group(1).replace('  ', '\t').split(',')
             if 'Data,' in line:
                 header['columns'] = [col.strip() for col in cols]
-                lines[il] = lines[il][:lines[il].find('\t')]
-                data = [list(map(float, s)) for s in [re.split(r'\s+', dat.strip()) for dat in lines[il:]]]
-                df = pd.DataFrame.from_records(data, columns=header['columns'])
+                first = np.array(line[:line.find('\t')].split(), dtype=float)
                 break
-            else:
-                for ic, col in enumerate(cols):
-                    header[col.strip()] = sline[ic].strip()
+            sline = _CDE_SPLIT.split(line)
+            for ic, col in enumerate(cols):
+                header[col.strip()] = sline[ic].strip()
         else:
-            raise ValueError('This should not be.\nAll lines in header should include "<"')
-    # remove outliers from thickness    
-    #df_filt = filt_edge_percent(filt_3sigma(df,['Site 1 Layer 1 Thickness (A)']), ['Site 1 Layer 1 Thickness (A)'])
+            raise ValueError('No "<Data, ...>" line in %s.RsM' % filename)
+        # rest of the file is whitespace delimited floats
+        df = pd.read_csv(f, header=None, names=header['columns'], sep=r'\s+',
+                         dtype=np.float64, engine='c')
+    df = pd.concat([pd.DataFrame([first], columns=header['columns']), df], ignore_index=True)
+    if compact:
+        df = _compact(df, 'cde', filename)
     return CDESummary(header, df)
 
-def read_waferview(fileName, rm_param=None, rm_gt=None, rm_lt=None):
-    """return named tuple with header and dataframe from WaferView test file"""
-    WaferViewSummary = collections.namedtuple('WaferView_File', ['header', 'dataframe'])
-    with open(fileName + '.txt') as f:
-        header = {}
-        for l in f:
-            if l.strip('\n') == "!begin_data":
-                # data \n
-                header['columns'] = f.readline().strip('! ').strip('\n').split()
-                break
+def _scan_waferview(fileName):
+    """Return (header, data offset) of WaferView file found with one mmap scan for !begin_data"""
+    header = {}
+    with open(fileName, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            raise ValueError('Empty WaferView file: %s' % fileName)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[:11] == b'!begin_data':
+                begin = 0
             else:
-                # ! name: value \n
-                attribute =  l.strip('! ').strip('\n').split(': ')
-                if len(attribute) == 2:
-                    header[attribute[0]] = attribute[1]
-        # get data into dataframe
-        df = pd.read_csv(f, header=None, names=header['columns'], delim_whitespace=True, comment='!')
+                begin = mm.find(b'\n!begin_data')
+                if begin < 0:
+                    raise ValueError('No "!begin_data" in WaferView file: %s' % fileName)
+                begin += 1
+            # columns are the line after !begin_data
+            col_start = mm.find(b'\n', begin) + 1
+            col_end = mm.find(b'\n', col_start)
+            if col_end < 0:
+                col_end = size
+            head = mm[:begin].decode('ascii', 'replace')
+            columns = mm[col_start:col_end].decode('ascii', 'replace')
+    for l in head.splitlines():
+        # ! name: value \n
+        attribute =  l.strip('! ').split(': ')
+        if len(attribute) == 2:
+            header[attribute[0]] = attribute[1]
+    header['columns'] = columns.strip('! \r\n').split()
+    return header, col_end + 1
+
+def _waferview_dtypes(f, columns):
+    """Return explicit dtype map sniffed from the first data row of f (then rewinds f),
+    read_waferview falls back to an untyped read when a later row does not fit"""
+    pos = f.tell()
+    first = b'!'
+    while first.startswith(b'!'):
+        first = f.readline()
+        if not first:
+            break
+        first = first.strip()
+    f.seek(pos)
+    dtypes = {}
+    for col, tok in zip(columns, first.split()):
+        try:
+            int(tok)
+            if col in WAFERVIEW_DIE_COLUMNS:
+                dtypes[col] = 'int64'
+            # other int looking columns may hold floats later, let the parser decide
+        except ValueError:
+            try:
+                float(tok)
+                dtypes[col] = 'float64'
+            except ValueError:
+                pass
+    return dtypes
+
+def _match_columns(columns, names):
+    """Return columns matching names exactly or, failing that, by first prefix (case insensitive)"""
+    out = []
+    for name in names:
+        if name in columns:
+            match = name
+        else:
+            p = re.compile(re.escape(name) + '.*', flags=re.IGNORECASE)
+            matches = list(filter(p.match, columns))
+            if not matches:
+                raise ValueError('no matching comumn: "%s" ??' % name)
+            match = matches[0]
+        if match not in out:
+            out.append(match)
+    return out
+
+@file_cache.cached('.txt')
+def read_waferview(fileName, rm_param=None, rm_gt=None, rm_lt=None, usecols=None, compact=False):
+    """return named tuple with header and dataframe from WaferView test file
+     Args:
+        fileName (str): path of WaferView file without .txt.
+        rm_param (:obj:`str`, optional): column to filter rows on with rm_gt and rm_lt.
+        rm_gt (:obj:`float`, optional): remove rows with rm_param > rm_gt.
+        rm_lt (:obj:`float`, optional): remove rows with rm_param < rm_lt.
+        usecols (:obj:`list`, optional): only load these columns (name or prefix) plus
+            DieNum, DieX and DieY.
+        compact (:obj:`bool`, optional): apply COMPACT_PROFILES['waferview'] (int32 die
+            columns, float32 measurements, categorical strings) and print memory saved.
+    """
+    WaferViewSummary = collections.namedtuple('WaferView_File', ['header', 'dataframe'])
+    header, offset = _scan_waferview(fileName + '.txt')
+    columns = header['columns']
+    if usecols:
+        names = [c for c in WAFERVIEW_DIE_COLUMNS if c in columns] + list(usecols)
+        if rm_param:
+            names.append(rm_param)
+        usecols = _match_columns(columns, names)
+    with open(fileName + '.txt', 'rb') as f:
+        f.seek(offset)
+        dtypes = _waferview_dtypes(f, columns)
+        if usecols:
+            dtypes = {k: v for k, v in dtypes.items() if k in usecols}
+        # get data into dataframe (C engine, whitespace delimited)
+        try:
+            df = pd.read_csv(f, header=None, names=columns, sep=r'\s+', comment='!',
+                             dtype=dtypes, usecols=usecols, engine='c')
+        except ValueError:
+            # a later row does not fit the types of the first (text like '--'), let the parser decide
+            f.seek(offset)
+            df = pd.read_csv(f, header=None, names=columns, sep=r'\s+', comment='!',
+                             usecols=usecols, engine='c')
+    if usecols:
+        df = df[usecols]
+    if 'DieNum' in df and not df['DieNum'].is_monotonic_increasing:
         df = df.sort_values('DieNum')
+    summary = WaferViewSummary(header, df)
+
+    if rm_param:
+        rm_param = [get_target_param(summary, target_param=rm_param)]
+        if rm_gt is None and rm_lt is None:
+            raise ValueError("With rm_param sepcified at least  one of rm_gt or rm_lt must be specified")
+        filt = None
+        if rm_gt is not None:
+            filt = lt(rm_gt)
+        if rm_lt is not None:
+            filt = gt(rm_lt) if filt is None else filt & gt(rm_lt)
+        df, report = apply_filters(df, filt, rm_param, report=True)
+        for stage in report:
+            print('removed %s rows where %s not %s' % (stage.removed, stage.column, stage.name))
         summary = WaferViewSummary(header, df)
-      
-        orr = df.shape[0]
-        if rm_param:
-            rm_param = [get_target_param(summary, target_param=rm_param)]
-            if rm_gt:
-                df = filt_lt(df, columns=rm_param, val=rm_gt)
-                print('removed %s rows where %s > %s' % (orr - df.shape[0], rm_param, rm_gt))
-            if rm_lt:
-                df = filt_gt(df, columns=rm_param, val=rm_lt)
-                print('removed %s rows where %s < %s' % (orr - df.shape[0], rm_param, rm_gt))
-            if not rm_gt or rm_lt:
-                raise ValueError("With rm_param sepcified at least  one of rm_gt or rm_lt must be specified")
-            summary = WaferViewSummary(header, df)       
+    if compact:
+        summary = WaferViewSummary(header, _compact(summary.dataframe, 'waferview', fileName))
     return summary
 
-def read_ibe(file):
-    """return named tuple with header and dataframe from ibe trim file"""
+def _read_lot_wafer(base_path, freq, wafer, test_step, d8_num, test_spec, file_num, kwargs):
+    """Return (path, seconds, error, header, dataframe) for one wafer of read_lot
+    (plain tuple so it can come back from a process pool)"""
+    start = time.perf_counter()
+    path = None
+    def load():
+        nonlocal path
+        full_path = find_test_path(base_path, str(freq), str(wafer), test_step, d8_num, test_spec)
+        fname = get_filename(full_path, file_num)
+        if not fname:
+            raise FileNotFoundError('No test file %s in %s' % (file_num, full_path))
+        path = os.path.join(full_path, fname)
+        return read_waferview(path, **kwargs)
+    result = Either.Try(load).map(tuple)
+    header, df = result.right or (None, None)
+    return path, time.perf_counter() - start, result.left, header, df
+
+def read_lot(freq, wafers, test_step, d8_num, test_spec='', file_num=-1, concat=True,
+             max_workers=8, processes=False, base_path=None, **kwargs):
+    """Read the WaferView file of many wafers concurrently.
+    A failing wafer is reported and does not stop the rest of the lot.
+     Args:
+        freq (str): frequency folder in ptestbend.
+        wafers (list): wafer ids.
+        test_step (str): "ResonatorMap", "WaferMap", ...
+        d8_num (str): d8 number of the test spec.
+        test_spec (:obj:`str`, optional): test spec prefix, "" to auto find.
+        file_num (:obj:`int`, optional): file number, -1 most recent (see get_filename).
+        concat (:obj:`bool`, optional): return one dataframe with a wafer column
+            rather than a dict of WaferView_File.
+        max_workers (:obj:`int`, optional): max files read at once.
+        processes (:obj:`bool`, optional): use a process pool instead of threads.
+        base_path (:obj:`str`, optional): default find_base_path().
+        **kwargs: passed to read_waferview (rm_param, usecols, compact, cache, ...).
+    Returns:
+        Lot_File(data, report): data is a dataframe or {wafer: WaferView_File};
+            report is a dataframe of wafer, path, seconds, rows, bytes and error.
+    """
+    LotSummary = collections.namedtuple('Lot_File', ['data', 'report'])
+    WaferViewSummary = collections.namedtuple('WaferView_File', ['header', 'dataframe'])
+    if base_path is None:
+        base_path = find_base_path()
+    pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with pool(max_workers=max_workers) as ex:
+        futures = [ex.submit(_read_lot_wafer, base_path, freq, wafer, test_step, d8_num,
+                             test_spec, file_num, kwargs) for wafer in wafers]
+        results = [fut.result() for fut in futures]
+
+    data = {}
+    report = []
+    for wafer, (path, seconds, error, header, df) in zip(wafers, results):
+        if error:
+            report.append((wafer, path, seconds, 0, 0, error))
+        else:
+            data[wafer] = WaferViewSummary(header, df)
+            report.append((wafer, path, seconds, df.shape[0], int(df.memory_usage(deep=True).sum()), None))
+    report = pd.DataFrame(report, columns=['wafer', 'path', 'seconds', 'rows', 'bytes', 'error'])
+    if concat:
+        frames = []
+        for wafer, summary in data.items():
+            df = summary.dataframe.reset_index(drop=True)
+            df.insert(0, 'wafer', wafer)
+            frames.append(df)
+        data = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+        if kwargs.get('compact') and frames:
+            data['wafer'] = data['wafer'].astype('category')
+    return LotSummary(data, report)
+
+def _scan_ibe(mm):
+    """Return (header, body offset) from the % lines at the start of a mapped ibe file"""
+    header = {}
+    pos = 0
+    while mm[pos:pos + 1] == b'%':
+        end = mm.find(b'\n', pos)
+        if end < 0:
+            end = len(mm)
+        l = mm[pos:end].decode('ascii').strip('%').strip('\r\n')
+        pos = end + 1
+        if l[0:1] == 'm':
+            header['units'] = l.split()
+            break
+        elif l[0:1] == 'x':
+            header['columns'] = l.split()
+        elif l[0:3] == 'ibe':
+            # ibe-file \t name: \t value \t name: \t value ...
+            vals = l.split('\t')
+            for ii in range(1, len(vals) - 1, 2):
+                header[vals[ii].strip(':')] = vals[ii + 1]
+        else:
+            raise ValueError('Improper header for ibe!!??')
+    return header, min(pos, len(mm))
+
+@file_cache.cached('.ibe')
+def read_ibe(file, header_only=False, dtype=np.float64):
+    """Return named tuple with header and dataframe from ibe trim file, (None, None) if missing.
+    The header is parsed from a memory map of the file, so header_only reads (target, a, b, c)
+    never touch the body.
+     Args:
+        file (str): path without .ibe.
+        header_only (:obj:`bool`, optional): skip the body, dataframe is None.
+        dtype (:obj:`np.dtype`, optional): np.float64 or np.float32 body columns.
+    """
     ibeSummary = collections.namedtuple('ibe_File', ['header', 'dataframe'])
     if not os.path.exists(file + '.ibe'):
         return ibeSummary(None, None)
-    with open(file + '.ibe','rb') as f:
-        header = {}
-        for l in f:
-            #print(l)
-            l = l.decode('ascii')
-            #print(l)
-            if l.strip('\n')[0:2] == "%m":
-                header['units'] = l.strip('%').strip('\r\n').split()
-                break
-            elif l.strip('\n')[0:2] == "%x":
-                header['columns'] = l.strip('%').strip('\r\n').split()
-            elif l.strip('\n')[0:4] == "%ibe":
-                vals = l.strip('%').strip('\r\n').split('\t')
-                # get data
-                for ii, val in enumerate(vals):
-                    if ii < 1:
-                        continue
-                    if ii%2 == 0:
-                        continue
-                    if ii < len(vals)-1:
-                         header[val.strip(':')] = vals[ii+1]
-            elif l.strip('\n')[0:1] != "%":
-                    break
-            else:
-                raise ValueError('Improper header for ibe!!??')
-        # get data into dataframe
-        df = pd.read_csv(f, header=None, names=header['columns'], delim_whitespace=True, comment='!')
+    with open(file + '.ibe', 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            raise ValueError('Empty ibe file: %s' % file)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            header, offset = _scan_ibe(mm)
+            if header_only:
+                return ibeSummary(header, None)
+            columns = header.get('columns', ['x', 'y', 'removal'])
+            mm.seek(offset)
+            # get data into dataframe (C engine, whitespace delimited)
+            df = pd.read_csv(mm, header=None, names=columns, sep=r'\s+', comment='!',
+                             dtype={c: dtype for c in columns}, engine='c')
     return ibeSummary(header, df)
 
-def write_ibe(file, ibe_filt, target, rate_f):
-    # Write the ibe
-    with open(file,'w', newline='\r\n') as f:
-        data = [target] + rate_f
-        f.write('%ibe-file\ttarget:\t{0}\ta:\t{1}\tb:\t{2}\tc:\t{3}\n'.format(*data))
-        f.write('%x\ty\tremoval\n')
-        f.write('%mm\tmm\tnm\n')
-        ibe_filt.to_csv(f, header=False, index=False, mode='a', sep="\t", quoting=csv.QUOTE_NONE)
+IBE_PRECISION = 6
+
+def _format_fixed(values, precision):
+    """Return (n, width) uint8 array of values as fixed point ascii, right aligned, 0 padded.
+    NaN gives an empty field (like to_csv), zero bytes are dropped by encode_ibe.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    finite = np.isfinite(values)
+    scaled = np.rint(np.where(finite, np.abs(values), 0) * 10**precision)
+    if scaled.size and scaled.max() >= 2**62:
+        raise ValueError('value too large for fixed precision %d' % precision)
+    scaled = scaled.astype(np.int64)
+    neg = (values < 0) & (scaled > 0)
+    int_digits = np.maximum(1, np.floor(np.log10(np.maximum(scaled // 10**precision, 1))).astype(np.int64) + 1)
+    n_int = int(int_digits.max()) if values.size else 1
+    width = 1 + n_int + (precision + 1 if precision else 0)
+    out = np.zeros((values.size, width), dtype=np.uint8)
+    col = width - 1
+    rest = scaled
+    for ii in range(precision):
+        out[:, col] = ord('0') + rest % 10
+        rest = rest // 10
+        col -= 1
+    if precision:
+        out[:, col] = ord('.')
+        col -= 1
+    for ii in range(n_int):
+        digit = rest % 10
+        out[:, col] = np.where(ii < int_digits, ord('0') + digit, 0)
+        rest = rest // 10
+        col -= 1
+    sign_col = width - 1 - (precision + 1 if precision else 0) - int_digits
+    out[np.nonzero(neg)[0], sign_col[neg]] = ord('-')
+    out[~finite] = 0
+    return out
+
+def encode_ibe(ibe_filt, target, rate_f, precision=IBE_PRECISION):
+    """Return the .ibe file as bytes (CRLF line ends).
+    The body is formatted from the column buffers in one preallocated byte array,
+    with fixed precision decimals.
+     Args:
+        ibe_filt (pd.dataframe, np.array): x[mm], y[mm], removal[nm] columns.
+        target (str): target written to the header.
+        rate_f (list): [a, b, c] written to the header.
+        precision (:obj:`int`, list, optional): decimals, for all or per column.
+    """
+    cols = ibe_filt.to_numpy(dtype=np.float64) if isinstance(ibe_filt, pd.DataFrame) else np.asarray(ibe_filt, dtype=np.float64)
+    if isinstance(precision, int):
+        precision = [precision] * cols.shape[1]
+    data = [target] + list(rate_f)
+    header = ('%ibe-file\ttarget:\t{0}\ta:\t{1}\tb:\t{2}\tc:\t{3}\r\n'.format(*data) +
+              '%x\ty\tremoval\r\n'
+              '%mm\tmm\tnm\r\n').encode()
+    fields = [_format_fixed(cols[:, ii], p) for ii, p in enumerate(precision)]
+    seps = np.zeros((cols.shape[0], len(fields) + 1), dtype=np.uint8)
+    seps[:, :-1] = ord('\t')
+    # every row: field, \t, field, \t, ..., field, \r\n
+    parts = []
+    for ii, field in enumerate(fields):
+        parts.append(field)
+        if ii < len(fields) - 1:
+            parts.append(seps[:, ii:ii + 1])
+    parts.append(np.tile(np.frombuffer(b'\r\n', dtype=np.uint8), (cols.shape[0], 1)))
+    body = np.hstack(parts).ravel()
+    return header + body[body != 0].tobytes()
+
+def write_ibe(file, ibe_filt, target, rate_f, precision=IBE_PRECISION):
+    """Write the ibe to file, or to every path of a list (like backup and Scia) from one encode.
+    Each file is written to a temp file and moved in place, readers never see half a file.
+     Args:
+        file (str, list): path or paths.
+        ibe_filt (pd.dataframe): x[mm], y[mm], removal[nm].
+        target (str): target written to the header.
+        rate_f (list): [a, b, c] written to the header.
+        precision (:obj:`int`, list, optional): decimals, for all or per column.
+    """
+    data = encode_ibe(ibe_filt, target, rate_f, precision)
+    for path in ([file] if isinstance(file, str) else file):
+        with atomic_write(path) as tmp:
+            with open(tmp, 'wb') as f:
+                f.write(data)
 
 def file_not_exist(file):
     """Return true or false depending is file exist"""
@@ -254,7 +576,7 @@ def exist_dir(d8_path):
     """
     ensures that the new path is actually a directory
     """
-    if not os.path.isdir(d8_path):
+    if not dir_index.isdir(d8_path):
         raise NotADirectoryError("The file at {0} is not a directory and so cannot be used for Yield Analysis".format(d8_path))
     else:
         return True
@@ -282,7 +604,7 @@ def find_d8_path(freq, wafer_id, test_step, test_spec):
     test_step_path = os.path.join(find_base_path() ,str(freq), str(wafer_id), str(test_step))
     
     def pathIO():        
-        d8_path =(Either.Try(lambda: [x for x in os.listdir(test_step_path) if x.lower()[0:len(test_spec)] == test_spec.lower()]) # finad all matching test spec
+        d8_path =(Either.Try(lambda: [x for x in dir_index.listdir(test_step_path) if x.lower()[0:len(test_spec)] == test_spec.lower()]) # finad all matching test spec
                   .filter(lambda x: exist_spec(x,test_spec,test_step_path)) # f checks the that the length of the returned list is 1
                   .map(lambda x: x[0]) # extract the first element
                   .map(lambda x: os.path.join(test_step_path, x)) # join that element to make a path
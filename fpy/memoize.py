@@ -1,10 +1,30 @@
 import pickle
+import time
+import atexit
+import asyncio
+import threading
 import collections
+import hashlib
+import sqlite3
 import functools
 import inspect
 import os.path
 import re
 import unicodedata
+try:
+    import numpy as np
+    import pandas as pd
+except ImportError:
+    np = pd = None
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
 
 class Memorize(object):
     '''
@@ -13,40 +33,183 @@ class Memorize(object):
     later with the same arguments, the cached value is
     returned (the function is not reevaluated). The cache is
     stored as a .cache file in the current directory for reuse
-    in future executions. If the Python file containing the
-    decorated function has been updated since the last run,
-    the current cache is deleted and a new cache is created
-    (in case the behavior of the function has changed).
+    in future executions. If the source (or bytecode) of the
+    decorated function has changed since the last run, the
+    current cache is deleted and a new cache is created (in
+    case the behavior of the function has changed).
+
+    Arguments are keyed by content: numpy arrays and pandas
+    objects are hashed from their buffers (xxhash if installed,
+    else blake2), kwargs are supported, anything else is
+    pickled. Arguments that can not be keyed skip the cache.
+
+    The default 'sqlite' backend looks keys up lazily, batches
+    writes (flush_every misses and at exit) and compacts the
+    file when it has many free pages. backend='pickle' keeps
+    the old single pickled dict. Options are given like this:
+
+    @Memorize(backend='sqlite', flush_every=100)
+    def fit(...):
+
+    maxsize (entries), max_bytes (pickled size) and ttl (seconds)
+    bound the cache, in memory and on disk, evicting the least
+    recently used values first. cache_info() reports hits,
+    misses, evictions and current size like functools.lru_cache;
+    evictions counts values dropped from the store (gone from the
+    cache), memory_evictions and disk_evictions count each tier.
+
+    cache_dir (default $FPY_MEMOIZE_DIR or the current directory)
+    can be a directory shared by several kernels and users. Files
+    are written by write-then-rename under an advisory lock, the
+    pickle backend merges other writers' entries on save, and the
+    sqlite backend uses the rollback journal there (WAL only for
+    the local default directory, WAL does not work on network file
+    systems). Locks on SMB/NFS shares are only as good as the
+    server's: kernels on one machine are safe, writers on several
+    machines at once may still lose entries. async def functions
+    are supported; concurrent awaits of the same key share one call.
     '''
-    def __init__(self, func):
+    def __init__(self, func=None, backend='sqlite', flush_every=100,
+                 maxsize=None, max_bytes=None, ttl=None, cache_dir=None):
+        self.func = None
+        self.cache_dir = cache_dir or os.environ.get('FPY_MEMOIZE_DIR', '')
+        self.backend = backend
+        self.flush_every = flush_every
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.memory_evictions = 0
+        self.disk_evictions = 0
+        self.currbytes = 0
+        if backend not in STORES:
+            raise ValueError('backend must be one of %s' % list(STORES))
+        if func is not None:
+            self._wrap(func)
+
+    def _wrap(self, func):
+        """Set up the cache for func"""
         self.func = func
         self.set_parent_file() # Sets self.parent_filepath and self.parent_filename
         self.__name__ = self.func.__name__
+        self.__doc__ = self.func.__doc__
         self.set_cache_filename()
-        if self.cache_exists():
-            self.read_cache() # Sets self.timestamp and self.cache
-            if not self.is_safe_cache():
-                self.cache = {}
-        else:
-            self.cache = {}
+        self.cache = collections.OrderedDict() # key: (value, bytes, created), LRU order
+        self.lock = threading.RLock()
+        self.inflight = {} # key: asyncio.Future of a running async call
+        # an explicit (possibly network shared) cache_dir gets no WAL
+        self.store = STORES[self.backend](self.cache_filename, shared=bool(self.cache_dir))
+        self.fingerprint = _func_fingerprint(func)
+        if not self.is_safe_cache():
+            self.store.clear()
+            self.store.set_meta('fingerprint', self.fingerprint)
+        atexit.register(self.save_cache)
 
-    def __call__(self, *args):
-        if not isinstance(args, collections.Hashable):
-            return self.func(*args)
-        if args in self.cache:
-            return self.cache[args]
-        else:
-            value = self.func(*args)
-            self.cache[args] = value
-            self.save_cache()
+    def __call__(self, *args, **kwargs):
+        if self.func is None:
+            # used as @Memorize(options)
+            self._wrap(args[0])
+            return self
+        key = _make_key(args, kwargs)
+        if inspect.iscoroutinefunction(self.func):
+            return self._acall(key, args, kwargs)
+        if key is None:
+            return self.func(*args, **kwargs)
+        found, value = self._lookup(key)
+        if not found:
+            value = self.func(*args, **kwargs)
+            self._remember(key, value)
+        return value
+
+    async def _acall(self, key, args, kwargs):
+        """Await func, sharing one call between concurrent awaits of key"""
+        if key is None:
+            return await self.func(*args, **kwargs)
+        found, value = self._lookup(key)
+        if found:
             return value
+        if key in self.inflight:
+            return await asyncio.shield(self.inflight[key])
+        task = asyncio.ensure_future(self.func(*args, **kwargs))
+        self.inflight[key] = task
+        try:
+            value = await asyncio.shield(task)
+        finally:
+            self.inflight.pop(key, None)
+        self._remember(key, value)
+        return value
+
+    def _lookup(self, key):
+        """Return (found, value) from memory or the store"""
+        with self.lock:
+            if key in self.cache:
+                value, nbytes, created = self.cache[key]
+                if self.ttl is None or time.time() - created <= self.ttl:
+                    self.cache.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                self._discard(key)
+            found, value, nbytes, created = self.store.get(key, self.ttl)
+            if not found:
+                self.misses += 1
+                return False, None
+            self.hits += 1
+            self._hold(key, value, nbytes, created)
+            return True, value
+
+    def _remember(self, key, value):
+        """Store a newly computed value"""
+        with self.lock:
+            created = time.time()
+            nbytes = self.store.put(key, value, created)
+            if nbytes is None:
+                return # not picklable, not cached
+            if self.store.pending >= self.flush_every:
+                self.save_cache()
+            self._hold(key, value, nbytes, created)
+
+    def _hold(self, key, value, nbytes, created):
+        """Keep value in memory"""
+        if key in self.cache:
+            self._discard(key)
+        self.cache[key] = (value, nbytes, created)
+        self.currbytes += nbytes
+        self._evict()
+
+    def _discard(self, key):
+        """Drop key from memory"""
+        self.currbytes -= self.cache.pop(key)[1]
+
+    def _evict(self):
+        """Drop least recently used values from memory past maxsize or max_bytes"""
+        while self.cache and ((self.maxsize is not None and len(self.cache) > self.maxsize) or
+                              (self.max_bytes is not None and self.currbytes > self.max_bytes)):
+            self._discard(next(iter(self.cache)))
+            self.memory_evictions += 1
+
+    def cache_info(self):
+        """
+        Returns CacheInfo(hits, misses, evictions, maxsize,
+        currsize, currbytes, memory_evictions, disk_evictions),
+        currsize and currbytes are for values held in memory.
+        A value dropped from memory is still read back from the
+        store, evictions (= disk_evictions) counts each value
+        once when it leaves the cache.
+        """
+        return CacheInfo(self.hits, self.misses, self.disk_evictions, self.maxsize,
+                         len(self.cache), self.currbytes,
+                         self.memory_evictions, self.disk_evictions)
 
     def set_parent_file(self):
         """
         Sets self.parent_file to the absolute path of the
         file containing the memoized function.
         """
-        rel_parent_file = inspect.stack()[-1].filename
+        try:
+            rel_parent_file = inspect.getfile(self.func)
+        except TypeError:
+            rel_parent_file = inspect.stack()[-1].filename
         self.parent_filepath = os.path.abspath(rel_parent_file)
         self.parent_filename = _filename_from_path(rel_parent_file)
 
@@ -57,7 +220,9 @@ class Memorize(object):
         """
         filename = _slugify(self.parent_filename.replace('.py', ''))
         funcname = _slugify(self.__name__)
-        self.cache_filename = filename+'_'+funcname+'.cache'
+        self.cache_filename = os.path.join(self.cache_dir, filename+'_'+funcname+STORES[self.backend].ext)
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
 
     def get_last_update(self):
         """
@@ -69,38 +234,41 @@ class Memorize(object):
 
     def is_safe_cache(self):
         """
-        Returns True if the file containing the memoized
-        function has not been updated since the cache was
-        last saved.
+        Returns True if the memoized function is unchanged
+        (same source or bytecode fingerprint) since the cache
+        was last saved.
         """
-        if self.get_last_update() > self.timestamp:
-            return False
-        return True
+        return self.store.get_meta('fingerprint') == self.fingerprint
 
     def read_cache(self):
         """
-        Read a pickled dictionary into self.timestamp and
-        self.cache. See self.save_cache.
+        Drop values held in memory, they are read back
+        lazily from the store.
         """
-        with open(self.cache_filename, 'rb') as f:
-            data = pickle.loads(f.read())
-            self.timestamp = data['timestamp']
-            self.cache = data['cache']
+        self.cache.clear()
+        self.currbytes = 0
 
     def save_cache(self):
         """
-        Pickle the file's timestamp and the function's cache
-        in a dictionary object.
+        Write values computed since the last save to the store
+        and trim it to maxsize, max_bytes and ttl.
         """
-        with open(self.cache_filename, 'wb+') as f:
-            out = dict()
-            out['timestamp'] = self.get_last_update()
-            out['cache'] = self.cache
-            f.write(pickle.dumps(out))
+        with self.lock:
+            self.store.flush()
+            self.disk_evictions += self.store.trim(self.maxsize, self.max_bytes, self.ttl)
+
+    def clear_cache(self):
+        """
+        Remove all cached values, in memory and on disk.
+        """
+        self.cache.clear()
+        self.currbytes = 0
+        self.store.clear()
+        self.store.set_meta('fingerprint', self.fingerprint)
 
     def cache_exists(self):
         '''
-        Returns True if a matching cache exists in the current directory.
+        Returns True if a matching cache exists in the cache directory.
         '''
         if os.path.isfile(self.cache_filename):
             return True
@@ -114,6 +282,348 @@ class Memorize(object):
         """ Support instance methods. """
         return functools.partial(self.__call__, obj)
 
+
+class FileLock(object):
+    """Advisory lock on filename + '.lock' (flock, or msvcrt on Windows).
+    On SMB/NFS mounts the lock is only honoured if the server supports it.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename + '.lock'
+        self.f = None
+
+    def __enter__(self):
+        self.f = open(self.filename, 'a+')
+        if fcntl is not None:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+        else:
+            self.f.seek(0)
+            msvcrt.locking(self.f.fileno(), msvcrt.LK_LOCK, 1)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+        else:
+            self.f.seek(0)
+            msvcrt.locking(self.f.fileno(), msvcrt.LK_UNLCK, 1)
+        self.f.close()
+        self.f = None
+
+
+class PickleStore(object):
+    """Whole cache as one pickled dict, merged and rewritten on every flush.
+    shared is accepted for the same signature as SqliteStore, the merge under
+    FileLock and write-then-rename are the same either way.
+    """
+    ext = '.cache'
+
+    def __init__(self, filename, shared=False):
+        self.filename = filename
+        self.data = self._load()
+        self.dirty = set() # keys put since the last flush
+        self.removed = set() # keys removed since the last flush
+        self.cleared = False
+        self.pending = 0
+
+    def _load(self):
+        """Read the file, key info is [bytes, created, accessed]"""
+        data = {'meta': {}, 'cache': {}, 'info': {}}
+        if os.path.isfile(self.filename):
+            with open(self.filename, 'rb') as f:
+                data.update(pickle.loads(f.read()))
+        for key in data['cache']:
+            data['info'].setdefault(key, [0, 0, 0])
+        return data
+
+    def get_meta(self, name):
+        return self.data['meta'].get(name)
+
+    def set_meta(self, name, value):
+        self.data['meta'][name] = value
+        self.pending += 1
+
+    def get(self, key, ttl=None):
+        """Return (found, value, bytes, created)"""
+        if key not in self.data['cache']:
+            return False, None, 0, None
+        info = self.data['info'][key]
+        if ttl is not None and time.time() - info[1] > ttl:
+            self._remove(key)
+            return False, None, 0, None
+        info[2] = time.time()
+        return True, self.data['cache'][key], info[0], info[1]
+
+    def put(self, key, value, created):
+        """Store value, returns its pickled size or None if it can not be pickled"""
+        try:
+            nbytes = len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return None
+        self.data['cache'][key] = value
+        self.data['info'][key] = [nbytes, created, created]
+        self.dirty.add(key)
+        self.removed.discard(key)
+        self.pending += 1
+        return nbytes
+
+    def _remove(self, key):
+        del self.data['cache'][key]
+        del self.data['info'][key]
+        self.dirty.discard(key)
+        self.removed.add(key)
+        self.pending += 1
+
+    def trim(self, maxsize=None, max_bytes=None, ttl=None):
+        """Remove expired then least recently used values, returns number removed"""
+        info = self.data['info']
+        removed = 0
+        if ttl is not None:
+            now = time.time()
+            for key in [k for k, v in info.items() if now - v[1] > ttl]:
+                self._remove(key)
+                removed += 1
+        total = sum(v[0] for v in info.values())
+        for key in sorted(info, key=lambda k: info[k][2]):
+            if ((maxsize is None or len(info) <= maxsize) and
+                    (max_bytes is None or total <= max_bytes)):
+                break
+            total -= info[key][0]
+            self._remove(key)
+            removed += 1
+        if removed:
+            self.flush()
+        return removed
+
+    def flush(self):
+        """Merge our changes into the file on disk under a lock, write then rename"""
+        if not self.pending:
+            return
+        with FileLock(self.filename):
+            data = {'meta': {}, 'cache': {}, 'info': {}} if self.cleared else self._load()
+            for key in self.removed:
+                data['cache'].pop(key, None)
+                data['info'].pop(key, None)
+            for key in self.dirty:
+                data['cache'][key] = self.data['cache'][key]
+                data['info'][key] = self.data['info'][key]
+            data['meta'].update(self.data['meta'])
+            tmp = '%s.%d.tmp' % (self.filename, os.getpid())
+            with open(tmp, 'wb') as f:
+                f.write(pickle.dumps(data))
+            os.replace(tmp, self.filename)
+        self.data = data
+        self.dirty = set()
+        self.removed = set()
+        self.cleared = False
+        self.pending = 0
+
+    def clear(self):
+        self.data['cache'] = {}
+        self.data['info'] = {}
+        self.dirty = set()
+        self.removed = set()
+        self.cleared = True
+        self.pending += 1
+
+
+class SqliteStore(object):
+    """Cache in a sqlite file, one row per key, read lazily and written in batches.
+    Local files use WAL (readers do not block the writer). shared=True keeps the
+    rollback journal: WAL needs shared memory between the processes, which network
+    file systems (the SMB share) do not give. sqlite's own file locking over SMB/NFS
+    is also only as reliable as the server, use one writing machine per shared file.
+    """
+    ext = '.cache.db'
+    compact_ratio = 0.25  # VACUUM when this fraction of pages is free
+    columns = ['key', 'value', 'size', 'created', 'accessed']
+
+    def __init__(self, filename, shared=False):
+        self.filename = filename
+        # sqlite locks the file itself, wait for other writers instead of failing
+        self.con = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        # the journal mode is stored in the file, set it both ways
+        self.con.execute('PRAGMA journal_mode=%s' % ('DELETE' if shared else 'WAL'))
+        have = [row[1] for row in self.con.execute('PRAGMA table_info(cache)')]
+        if have and have != self.columns:
+            self.con.execute('DROP TABLE cache') # older layout, rebuild
+        self.con.execute('CREATE TABLE IF NOT EXISTS cache '
+                         '(key TEXT PRIMARY KEY, value BLOB, size INTEGER, created REAL, accessed REAL)')
+        self.con.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+        if [row[2] for row in self.con.execute('PRAGMA table_info(meta)')][1:] == ['REAL']:
+            self.con.execute('DROP TABLE meta') # older numeric timestamp layout
+        self.con.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value)')
+        self.con.commit()
+        self.writes = {}
+        self.touched = {}
+        self.compact()
+
+    @property
+    def pending(self):
+        return len(self.writes)
+
+    def get_meta(self, name):
+        row = self.con.execute('SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, name, value):
+        self.con.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (name, value))
+        self.con.commit()
+
+    def get(self, key, ttl=None):
+        """Return (found, value, bytes, created)"""
+        if key in self.writes:
+            raw, created = self.writes[key]
+        else:
+            row = self.con.execute('SELECT value, created FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return False, None, 0, None
+            raw, created = row
+        if ttl is not None and time.time() - created > ttl:
+            return False, None, 0, None # replaced by the next put, or trimmed
+        self.touched[key] = time.time()
+        return True, pickle.loads(raw), len(raw), created
+
+    def put(self, key, value, created):
+        """Queue value, returns its pickled size or None if it can not be pickled"""
+        try:
+            raw = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return None
+        self.writes[key] = (raw, created)
+        return len(raw)
+
+    def flush(self):
+        """Write pending values and access times in one transaction"""
+        if not (self.writes or self.touched):
+            return
+        with self.con:
+            self.con.executemany('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)',
+                                 ((k, raw, len(raw), created, created)
+                                  for k, (raw, created) in self.writes.items()))
+            self.con.executemany('UPDATE cache SET accessed = ? WHERE key = ?',
+                                 ((t, k) for k, t in self.touched.items()))
+        self.writes = {}
+        self.touched = {}
+
+    def trim(self, maxsize=None, max_bytes=None, ttl=None):
+        """Remove expired then least recently used rows, returns number removed"""
+        removed = 0
+        with self.con:
+            if ttl is not None:
+                removed += self.con.execute('DELETE FROM cache WHERE created < ?',
+                                            (time.time() - ttl,)).rowcount
+            if maxsize is not None or max_bytes is not None:
+                count, total = self.con.execute('SELECT COUNT(*), TOTAL(size) FROM cache').fetchone()
+                drop = []
+                for key, size in self.con.execute('SELECT key, size FROM cache ORDER BY accessed'):
+                    if ((maxsize is None or count <= maxsize) and
+                            (max_bytes is None or total <= max_bytes)):
+                        break
+                    drop.append((key,))
+                    count -= 1
+                    total -= size
+                self.con.executemany('DELETE FROM cache WHERE key = ?', drop)
+                removed += len(drop)
+        return removed
+
+    def clear(self):
+        self.writes = {}
+        self.touched = {}
+        with self.con:
+            self.con.execute('DELETE FROM cache')
+        self.compact()
+
+    def compact(self):
+        """VACUUM the file if many pages are free"""
+        pages = self.con.execute('PRAGMA page_count').fetchone()[0]
+        free = self.con.execute('PRAGMA freelist_count').fetchone()[0]
+        if pages and free > self.compact_ratio * pages:
+            self.con.execute('VACUUM')
+
+
+STORES = {'sqlite': SqliteStore, 'pickle': PickleStore}
+
+CacheInfo = collections.namedtuple('CacheInfo', ['hits', 'misses', 'evictions', 'maxsize', 'currsize', 'currbytes',
+                                                 'memory_evictions', 'disk_evictions'])
+
+def _new_hash():
+    if xxhash is not None:
+        return xxhash.xxh3_128()
+    return hashlib.blake2b(digest_size=20)
+
+def _feed(h, obj):
+    """
+    Feeds obj into hash h by content. Arrays and pandas
+    objects are hashed from their buffers, containers
+    recursively and anything else by pickle.
+    """
+    h.update(type(obj).__qualname__.encode('utf-8'))
+    if obj is None or isinstance(obj, (bool, int, float, complex, str)):
+        h.update(repr(obj).encode('utf-8'))
+    elif isinstance(obj, (bytes, bytearray)):
+        h.update(obj)
+    elif isinstance(obj, (tuple, list)):
+        h.update(b'%d' % len(obj))
+        for item in obj:
+            _feed(h, item)
+    elif isinstance(obj, dict):
+        h.update(b'%d' % len(obj))
+        for k in sorted(obj, key=repr):
+            _feed(h, k)
+            _feed(h, obj[k])
+    elif np is not None and isinstance(obj, np.ndarray):
+        h.update(('%s%s' % (obj.dtype.str, obj.shape)).encode('utf-8'))
+        if obj.dtype.hasobject:
+            _feed(h, obj.ravel().tolist())
+        else:
+            h.update(np.ascontiguousarray(obj).view(np.uint8).ravel())
+    elif pd is not None and isinstance(obj, (pd.DataFrame, pd.Series)):
+        if isinstance(obj, pd.DataFrame):
+            _feed(h, [str(c) for c in obj.columns])
+            _feed(h, [str(d) for d in obj.dtypes])
+        else:
+            _feed(h, [str(obj.name), str(obj.dtype)])
+        _feed(h, pd.util.hash_pandas_object(obj, index=True).to_numpy())
+    elif pd is not None and isinstance(obj, pd.Index):
+        _feed(h, pd.util.hash_pandas_object(obj).to_numpy())
+    else:
+        h.update(pickle.dumps(obj, protocol=4))
+
+def _make_key(args, kwargs=None):
+    """
+    Returns a stable hex digest of the args and kwargs
+    content, or None if they can not be keyed.
+    """
+    h = _new_hash()
+    try:
+        _feed(h, args)
+        _feed(h, sorted((kwargs or {}).items()))
+    except (pickle.PicklingError, TypeError, AttributeError, ValueError):
+        return None
+    return h.hexdigest()
+
+def _func_fingerprint(func):
+    """
+    Returns a hex digest of the source of func, or of its
+    bytecode and constants if the source is not available.
+    """
+    h = hashlib.blake2b(digest_size=20)
+    try:
+        h.update(inspect.getsource(func).encode('utf-8'))
+    except (OSError, TypeError):
+        code = getattr(func, '__code__', None)
+        todo = [code] if code is not None else []
+        while todo:
+            code = todo.pop()
+            h.update(code.co_code)
+            for const in code.co_consts:
+                if inspect.iscode(const):
+                    todo.append(const)
+                else:
+                    h.update(repr(const).encode('utf-8'))
+    return h.hexdigest()
+
 def _slugify(value):
     """
     Normalizes string, converts to lowercase, removes
@@ -128,4 +638,4 @@ def _slugify(value):
     return value
 
 def _filename_from_path(filepath):
-    return filepath.split('/')[-1]
\ No newline at end of file
+    return filepath.split('/')[-1]
@@ -1,12 +1,90 @@
+import hashlib
+from collections import OrderedDict
 import numpy as np
-import scipy as sp
+from scipy import sparse
+from scipy.interpolate import CloughTocher2DInterpolator
 import matplotlib.pyplot as plt
 from matplotlib.patches import Arc
+from matplotlib.path import Path
+from matplotlib.widgets import RectangleSelector, LassoSelector
+from scipy.spatial import cKDTree, Delaunay
+
+class Selection(object):
+    """Array backed set of selected point indices with O(1) add, discard and toggle.
+    Iterates (and deep copies to a list) as [ind, x, y] like the old points list,
+    so copy.deepcopy(af.points).sort(...) keeps working.
+
+    Attributes:
+        indices (np.array): selected indices in selection order.
+        mask (np.array): bool array, True for selected points.
+    """
+
+    def __init__(self, x, y):
+        self._x = x
+        self._y = y
+        self._slot = np.full(len(x), -1, dtype=np.intp)  # index -> slot in _order
+        self._order = np.empty(len(x), dtype=np.intp)  # slot -> index
+        self._n = 0
+
+    def add(self, ind):
+        if self._slot[ind] < 0:
+            self._slot[ind] = self._n
+            self._order[self._n] = ind
+            self._n += 1
+
+    def discard(self, ind):
+        slot = self._slot[ind]
+        if slot >= 0:
+            # move last selected into the freed slot
+            last = self._order[self._n - 1]
+            self._order[slot] = last
+            self._slot[last] = slot
+            self._slot[ind] = -1
+            self._n -= 1
+
+    def toggle(self, ind):
+        """Select ind if not selected else unselect, returns True if now selected"""
+        if self._slot[ind] < 0:
+            self.add(ind)
+            return True
+        self.discard(ind)
+        return False
+
+    def clear(self):
+        self._slot[self._order[:self._n]] = -1
+        self._n = 0
+
+    @property
+    def indices(self):
+        return self._order[:self._n].copy()
+
+    @property
+    def mask(self):
+        return self._slot >= 0
+
+    def __contains__(self, ind):
+        return self._slot[ind] >= 0
+
+    def __len__(self):
+        return self._n
+
+    def __iter__(self):
+        for ind in self._order[:self._n]:
+            yield [int(ind), float(self._x[ind]), float(self._y[ind])]
+
+    def __deepcopy__(self, memo):
+        return list(self)
+
+    def __repr__(self):
+        return 'Selection(%s)' % list(self)
 
 class AnnoteFinder(object):
     """callback for matplotlib to display an annotation when points are
-    clicked on.  The point which is closest to the click and within
-    xtol and ytol is identified.
+    clicked on.  The points within xtol and ytol of the click are identified
+    with a cKDTree box query (log time, also for full wafers).
+    With batch=True all selected points are one scatter artist (updated with
+    set_offsets), the annotation of the last selected point is one reusable
+    text and every click or region select redraws once.
     Modified from: https://scipy-cookbook.readthedocs.io/items/Matplotlib_Interactive_Plotting.html
     
     Register this function like this:
@@ -15,16 +93,21 @@ class AnnoteFinder(object):
     ax.scatter(x, y)
     af =  AnnoteFinder(x, y, ax=ax)
     fig.canvas.mpl_connect('button_press_event', af)
+    af.select_region('lasso')  # drag to select many, af.select_region(None) for clicks
 
     Attributes:
+        x, y (np.array): ploted data.
+        annotes (list): anotation of each point.
         data (list): (x,y,anotation) data.
-        links (list): ToDo.
-        points (list): selected points.
+        links (list): AnnoteFinders that follow the selection, matched by annotation
+            (or by index when annotes were not given).
+        points (Selection): selected points.
         clicks (list): clicked points.
-        drawnAnnotations(list): points that have been drawn and annotated.
+        drawnAnnotations(list): points that have been drawn and annotated (batch=False).
+        batch (bool): single artist rendering.
     """
 
-    def __init__(self, xdata, ydata, annotes=None, ax=None, xtol=None, ytol=None):
+    def __init__(self, xdata, ydata, annotes=None, ax=None, xtol=None, ytol=None, batch=True):
         """ 
         Args:
         xdata (list): ploted x data.
@@ -33,26 +116,38 @@ class AnnoteFinder(object):
         ax (:obj:'mplax', optional): matplot lib axis to plot on.
         xtol (:obj:`int`, optional): tolerance for finding x from click.
         ytol (:obj:`int`, optional): tolerance for finding y from click.
+        batch (:obj:`bool`, optional): one artist for all selected points, False for
+            a scatter and text per point.
         """
-        # Value checking, create self.data:
+        # Value checking, create self.x, self.y, self.annotes:
         if len(ydata) != len(xdata):
                 raise ValueError('xdata and ydata must be same lenght')
+        self.x = np.asarray(xdata, dtype=np.float64)
+        self.y = np.asarray(ydata, dtype=np.float64)
+        self._annotated = bool(annotes)
         if annotes:
             if len(annotes) != len(xdata):
                 raise ValueError('annotes must be same lenght as xdata and ydata')
-            self.data = list(zip(xdata, ydata, annotes))
+            self.annotes = list(annotes)
         else:
-            annotes = [''] * len(xdata)
-            self.data = list(zip(xdata, ydata, annotes))
+            self.annotes = [''] * len(xdata)
+        # annotation -> indices, for linked finders (empty annotations never match)
+        self._annote_index = {}
+        for ii, a in enumerate(self.annotes):
+            if a:
+                self._annote_index.setdefault(a, []).append(ii)
             
         # x tolerance
         if xtol is None:
-            xtol = ((max(xdata) - min(xdata))/float(len(xdata)))/2
+            xtol = ((self.x.max() - self.x.min())/float(len(self.x)))/2
         # y tolerance
         if ytol is None:
-            ytol = ((max(ydata) - min(ydata))/float(len(ydata)))/2
+            ytol = ((self.y.max() - self.y.min())/float(len(self.y)))/2
         self.xtol = xtol
         self.ytol = ytol
+        # tree on tolerance scaled points, a click box is then a unit chebyshev ball
+        self._scale = np.array([self._nonzero(xtol, self.x), self._nonzero(ytol, self.y)])
+        self._tree = cKDTree(np.column_stack([self.x, self.y])/self._scale)
         # axis to plot on
         if ax is None:
             self.ax = plt.gca()
@@ -61,8 +156,23 @@ class AnnoteFinder(object):
         # init some things
         self.drawnAnnotations = {}
         self.links = []
-        self.points = []
+        self.points = Selection(self.x, self.y)
         self.clicks = []
+        self.batch = batch
+        self._highlight = None
+        self._label = None
+        self._selector = None
+
+    @staticmethod
+    def _nonzero(tol, values):
+        """tol, or a tiny width when all values are the same"""
+        if tol > 0:
+            return float(tol)
+        return 1e-12*max(1., float(np.abs(values).max()))
+
+    @property
+    def data(self):
+        return list(zip(self.x, self.y, self.annotes))
 
     def distance(self, x1, x2, y1, y2):
         """
@@ -71,6 +181,30 @@ class AnnoteFinder(object):
         """
         return(np.sqrt((x1 - x2)**2 + (y1 - y2)**2))
 
+    def find(self, clickX, clickY):
+        """Return sorted indices of points within xtol, ytol of (clickX, clickY)"""
+        inds = self._tree.query_ball_point(np.array([clickX, clickY])/self._scale, r=1., p=np.inf)
+        inds.sort()
+        return inds
+
+    def find_box(self, x1, x2, y1, y2):
+        """Return sorted indices of points inside the box x1..x2, y1..y2"""
+        lo = np.array([min(x1, x2), min(y1, y2)])
+        hi = np.array([max(x1, x2), max(y1, y2)])
+        half = (hi - lo)/2/self._scale
+        cand = np.array(self._tree.query_ball_point((lo + hi)/2/self._scale, r=half.max(), p=np.inf),
+                        dtype=np.intp)
+        keep = ((self.x[cand] >= lo[0]) & (self.x[cand] <= hi[0]) &
+                (self.y[cand] >= lo[1]) & (self.y[cand] <= hi[1]))
+        return np.sort(cand[keep])
+
+    def find_path(self, verts):
+        """Return sorted indices of points inside the polygon verts"""
+        verts = np.asarray(verts, dtype=np.float64)
+        cand = self.find_box(verts[:, 0].min(), verts[:, 0].max(), verts[:, 1].min(), verts[:, 1].max())
+        inside = Path(verts).contains_points(np.column_stack([self.x[cand], self.y[cand]]))
+        return cand[inside]
+
     def __call__(self, event):
 
         if event.inaxes:
@@ -78,52 +212,110 @@ class AnnoteFinder(object):
             clickX = event.xdata
             clickY = event.ydata
             # self.clicks.append([clickX, clickY])
+            if self._selector is not None and self._selector.get_active():
+                return  # the region selector has the mouse
             if (self.ax is None) or (self.ax is event.inaxes):
-                annotes = []
-                # print(event.xdata, event.ydata)
-                for ii, (x, y, a) in enumerate(self.data):
-                    if ((clickX-self.xtol < x < clickX+self.xtol) and
-                            (clickY-self.ytol < y < clickY+self.ytol)):
-                        annotes.append((ii, x, y, a))
+                self._select(self.find(clickX, clickY), ax=event.inaxes)
+
+    def _select(self, inds, mode='toggle', ax=None):
+        """update() inds here and in linked finders, by annotation (empty ones skipped),
+        or by index when this finder was built without annotes"""
+        if len(inds):
+            self.update(inds, mode, ax)
+            annotes = [self.annotes[ind] for ind in inds if self.annotes[ind]]
+            for l in self.links:
                 if annotes:
-                    #annotes.sort()
-                    #ind, x, y, annote = annotes[0]
-                    for ann in annotes:
-                        ind, x, y, annote = ann
-                        self.drawAnnote(event.inaxes, ind, x, y, annote)
-                        for l in self.links:
-                            l.drawSpecificAnnote(annote)
+                    l.update_annotes(annotes, mode)
+                elif not self._annotated and l.x.size == self.x.size:
+                    l.update(inds, mode)
+
+    def update(self, inds, mode='toggle', ax=None):
+        """Toggle, 'add' or 'remove' the selection of inds then redraw once"""
+        ax = self.ax if ax is None else ax
+        if not self.batch:
+            for ind in inds:
+                if mode == 'toggle' or (mode == 'add') != (ind in self.points):
+                    self.drawAnnote(ax, ind, self.x[ind], self.y[ind], self.annotes[ind])
+            return
+        op = {'toggle': self.points.toggle, 'add': self.points.add, 'remove': self.points.discard}[mode]
+        for ind in inds:
+            op(ind)
+        self._render(ax)
+
+    def update_annotes(self, annotes, mode='toggle'):
+        """update() every point with one of annotes (linked plots)"""
+        inds = []
+        for annote in annotes:
+            inds.extend(self._annote_index.get(annote, []))
+        if inds:
+            self.update(inds, mode)
+
+    def _render(self, ax):
+        """Show the selection with the one highlight scatter and label, then draw_idle"""
+        inds = self.points.indices
+        offsets = np.column_stack([self.x[inds], self.y[inds]])
+        if self._highlight is None:
+            self._highlight = ax.scatter(offsets[:, 0], offsets[:, 1], marker='d', c='r', zorder=100)
+            self._label = ax.text(0, 0, '', zorder=101, visible=False)
+        else:
+            self._highlight.set_offsets(offsets)
+        # label the last selected point that has an annotation
+        for ind in inds[::-1]:
+            if self.annotes[ind]:
+                self._label.set_position((self.x[ind], self.y[ind]))
+                self._label.set_text(" - %s" % self.annotes[ind])
+                self._label.set_visible(True)
+                break
+        else:
+            self._label.set_visible(False)
+        ax.figure.canvas.draw_idle()
+
+    def select_region(self, kind='rect', mode='add'):
+        """Select many points by dragging a rectangle (kind='rect') or lasso (kind='lasso').
+        While a region selector is active clicks do not toggle points, kind=None turns it off.
+        Returns the matplotlib selector (keep a reference or it stops working).
+        """
+        if self._selector is not None:
+            self._selector.set_active(False)
+            self._selector = None
+        if kind is None:
+            return None
+        if kind == 'rect':
+            def onselect(press, release):
+                self._select(self.find_box(press.xdata, release.xdata, press.ydata, release.ydata), mode)
+            self._selector = RectangleSelector(self.ax, onselect, useblit=True)
+        elif kind == 'lasso':
+            def onselect(verts):
+                self._select(self.find_path(verts), mode)
+            self._selector = LassoSelector(self.ax, onselect, useblit=True)
+        else:
+            raise ValueError('kind must be "rect", "lasso" or None')
+        return self._selector
 
     def drawAnnote(self, ax, ind, x, y, annote):
         """
         Draw the annotation on the plot
         """
         # remove if already there
-        if ind in self.drawnAnnotations:
-            markers = self.drawnAnnotations[ind]
+        if not self.points.toggle(ind):
+            markers = self.drawnAnnotations.pop(ind)
             #for m in markers:
                 #m.set_visible(not m.get_visible())
             if markers[0]:
                 markers[0].remove()  # text
             markers[1].remove()  # markers
             ax.figure.canvas.draw_idle()
-            # delete from drawnAnnotations and points
-            del self.drawnAnnotations[ind]
-            self.points.remove([ind, x, y])
         else:
             if annote:
                 t = ax.text(x, y, " - %s" % (annote),)
             else:
                 t = None
             m = ax.scatter([x], [y], marker='d', c='r', zorder=100)
-            self.points.append([ind, x, y])
             self.drawnAnnotations[ind] = (t, m)
             ax.figure.canvas.draw_idle()
 
     def drawSpecificAnnote(self, annote):
-        annotesToDraw = [(x, y, a) for x, y, a in self.data if a == annote]
-        for x, y, a in annotesToDraw:
-            self.drawAnnote(self.ax, x, y, a)
+        self.update_annotes([annote])
 
 def plot_scatter(xdata, ydata, xlabel, ylabel, ax):
     """plots and fits with a 1d line
@@ -138,53 +330,281 @@ def plot_scatter(xdata, ydata, xlabel, ylabel, ax):
     
     return ax
     
+def _line_sums(u, v, w=None):
+    """[Σw, Σwu, Σwv, Σwuu, Σwuv, Σwvv, Σwu³, Σwu⁴], unit weights if w is None"""
+    if w is None:
+        w = np.ones(u.size)
+    wu = w*u
+    wuu = wu*u
+    return np.array([w.sum(), wu.sum(), (w*v).sum(), wuu.sum(), (wu*v).sum(), (w*v*v).sum(),
+                     (wuu*u).sum(), (wuu*u*u).sum()])
+
+def _sums_line(sums):
+    """(slope, intercept, rsqd) of the (weighted) least squares line from _line_sums"""
+    n, su, sv, suu, suv, svv = sums[:6]
+    if n <= 0:
+        return np.nan, np.nan, np.nan
+    varu = suu - su*su/n
+    varv = svv - sv*sv/n
+    cov = suv - su*sv/n
+    slope = cov/varu if varu > 0 else np.nan
+    intercept = (sv - slope*su)/n
+    # coefficient of determination, 1 - var(residuals)/var(y)
+    rsqd = np.round(cov*cov/(varu*varv), decimals=2) if varu > 0 and varv > 0 else np.nan
+    return slope, intercept, rsqd
+
+def _robust_scale(r):
+    """Normal consistent MAD of residuals r"""
+    return 1.4826*np.median(np.abs(r - np.median(r))) if r.size else np.nan
+
+def _huber_line(u, v, w, c=1.345, threshold=3., max_iter=50, tol=1e-8):
+    """Huber M-estimate by IRLS (tuning constant c): returns slope, intercept,
+    inliers (|r| <= threshold*scale), IRLS weights
+    """
+    ww = w
+    slope, intercept, _ = _sums_line(_line_sums(u, v, ww))
+    for _ in range(max_iter):
+        r = v - (slope*u + intercept)
+        s = _robust_scale(r)
+        if not s > 0:
+            break
+        ww = w*np.minimum(1., c*s/np.maximum(np.abs(r), 1e-300))
+        new_slope, new_intercept, _ = _sums_line(_line_sums(u, v, ww))
+        done = abs(new_slope - slope) <= tol*(1 + abs(slope)) and abs(new_intercept - intercept) <= tol*(1 + abs(intercept))
+        slope, intercept = new_slope, new_intercept
+        if done:
+            break
+    r = v - (slope*u + intercept)
+    return slope, intercept, np.abs(r) <= threshold*_robust_scale(r), ww
+
+def _theil_sen_line(u, v, w, max_pairs=200000, threshold=3., seed=0):
+    """Theil-Sen: median of pair slopes (all pairs, or max_pairs random ones for large n).
+    Returns slope, intercept, inliers (|r| <= threshold*scale), None
+    """
+    n = u.size
+    if n*(n - 1)//2 <= max_pairs:
+        i, j = np.triu_indices(n, 1)
+    else:
+        rng = np.random.default_rng(seed)
+        i = rng.integers(0, n, max_pairs)
+        j = rng.integers(0, n, max_pairs)
+    du = u[j] - u[i]
+    ok = du != 0
+    slope = np.median((v[j] - v[i])[ok]/du[ok]) if ok.any() else np.nan
+    intercept = np.median(v - slope*u)
+    r = v - (slope*u + intercept)
+    return slope, intercept, np.abs(r) <= threshold*_robust_scale(r), None
+
+def _ransac_line(u, v, w, n_trials=200, threshold=None, seed=0, chunk=32):
+    """RANSAC: line through the random pair with the most (weighted) inliers, then least
+    squares on those inliers. threshold default 3 robust sigma of the Theil-Sen residuals.
+    Returns slope, intercept, inliers, None
+    """
+    if threshold is None:
+        ts_slope, ts_intercept, _, _ = _theil_sen_line(u, v, w, max_pairs=20000, seed=seed)
+        threshold = 3*_robust_scale(v - (ts_slope*u + ts_intercept))
+    rng = np.random.default_rng(seed)
+    i = rng.integers(0, u.size, n_trials)
+    j = rng.integers(0, u.size, n_trials)
+    ok = u[i] != u[j]
+    i, j = i[ok], j[ok]
+    slopes = (v[j] - v[i])/(u[j] - u[i])
+    intercepts = v[i] - slopes*u[i]
+    best, best_score = None, -1.
+    # score candidates a chunk at a time, (chunk, n) residuals
+    for start in range(0, slopes.size, chunk):
+        a = slopes[start:start + chunk, None]
+        b = intercepts[start:start + chunk, None]
+        score = ((np.abs(v - (a*u + b)) <= threshold)*w).sum(axis=1)
+        k = int(np.argmax(score))
+        if score[k] > best_score:
+            best, best_score = start + k, score[k]
+    if best is None:
+        return np.nan, np.nan, np.zeros(u.size, dtype=bool), None
+    inliers = np.abs(v - (slopes[best]*u + intercepts[best])) <= threshold
+    slope, intercept, _ = _sums_line(_line_sums(u[inliers], v[inliers], w[inliers]))
+    return slope, intercept, inliers, None
+
+ROBUST_FITS = {'huber': _huber_line, 'theilsen': _theil_sen_line, 'ransac': _ransac_line}
+
 class FitLinear(object):
     """Fit line to x, y data and plot on matplotlib ax.
+    Least squares fits (method 'ols', or 'wls' with weights) come from running
+    sums (n, Σx, Σy, Σxx, Σxy, Σyy of the centered data) so removing or
+    restoring k points refits in O(k); the error band is one vectorized pass
+    and drawn at band_points x values.
+    Robust methods ('huber' IRLS, 'theilsen', 'ransac') refit the points in the
+    fit with vectorized numpy and need no filt_gt/filt_3sigma pre-filtering;
+    their inliers can be reviewed and the fit written to IonTrim with update_ibe.
     
     Register this function like this:
     
     fig, ax = plt.subplots()
     ax.scatter(x, y)
     fit = FitLinear(x, y, ax=ax)
+    fit.exclude(af.points.indices)  # refit without the points selected in an AnnoteFinder of x, y
+    fit.set_method('huber')
+    fit.update_ibe(wafer, run)
 
     Attributes:
-        self.x
-        self.y
+        self.x (np.array): x of the points in the fit.
+        self.y (np.array): y of the points in the fit.
+        self.mask (np.array): bool, points of the data in the fit.
+        self.inliers (np.array): bool, points of the data the method kept (== mask for least squares).
+        self.method (str): 'ols', 'wls', 'huber', 'theilsen' or 'ransac'.
         self.slope
         self.intercept
-        self.rsqd
+        self.rsqd: R² (weighted) of the points in the fit for least squares; for robust
+            methods plain (unweighted) R² of the robust line over self.inliers.
         self.fit
+        self.band_points (int): x values the error band is drawn at.
     """
 
-    def __init__(self, xdata, ydata, ax=None):
+    band_points = 200
+
+    def __init__(self, xdata, ydata, ax=None, method='ols', weights=None, **robust_kw):
         """ 
         Args:
         xdata (list): ploted x data.
         ydata (list): ploted y data.
         ax (:obj:'mplax', optional): matplot lib axis to plot on.
+        method (:obj:`str`, optional): 'ols', 'wls', 'huber', 'theilsen' or 'ransac'.
+        weights (:obj:`list`, optional): point weights (required for 'wls', used by huber and ransac).
+        **robust_kw: passed to the robust fit (c, max_pairs, threshold, n_trials, seed, ...).
         fit (:obj:'mplax', optional): List pf mlp objects (line, yerrUpper, yerrLower, text).
         """
         # Value checking, create self.data:
         if len(ydata) != len(xdata):
                 raise ValueError('xdata and ydata must be same lenght')
-        self.x = xdata
-        self.y = ydata
+        self._check_method(method, weights)
+        self.method = method
+        self.robust_kw = robust_kw
         # axis to plot on
         if ax is None:
             self.ax = plt.gca()
         else:
             self.ax = ax
         # get fit data
-        self.slope, self.intercept, self.rsqd = self.get_fit(self.x, self.y)
+        self._set_data(xdata, ydata, weights)
         # plot it
         self.fit = self._plot_fit()
+
+    @staticmethod
+    def _check_method(method, weights):
+        if method not in ('ols', 'wls') and method not in ROBUST_FITS:
+            raise ValueError('method must be "ols", "wls", %s' % ', '.join('"%s"' % m for m in ROBUST_FITS))
+        if method == 'wls' and weights is None:
+            raise ValueError('method "wls" needs weights')
+
+    def _set_data(self, xdata, ydata, weights=None):
+        """New data: center and sum everything"""
+        self._x = np.asarray(xdata, dtype=np.float64)
+        self._y = np.asarray(ydata, dtype=np.float64)
+        if weights is not None and len(weights) != self._x.size:
+            raise ValueError('weights must be same lenght as xdata and ydata')
+        self._w0 = np.ones(self._x.size) if weights is None else np.asarray(weights, dtype=np.float64)
+        self._w = self._w0
+        # centered copies keep the sums well conditioned
+        self._x0 = self._x.mean() if self._x.size else 0.
+        self._y0 = self._y.mean() if self._y.size else 0.
+        self._u = self._x - self._x0
+        self._v = self._y - self._y0
+        self.mask = np.ones(self._x.size, dtype=bool)
+        self._sums = _line_sums(self._u, self._v, self._w)
+        self._update_params()
+
+    def _update_params(self):
+        if self.method in ROBUST_FITS:
+            act = np.flatnonzero(self.mask)
+            slope, intercept, inl, w = ROBUST_FITS[self.method](self._u[act], self._v[act], self._w0[act],
+                                                                **self.robust_kw)
+            self.inliers = np.zeros(self.mask.size, dtype=bool)
+            self.inliers[act[inl]] = True
+            self._w = self._w0.copy()
+            if w is not None:
+                self._w[act] = w
+            self._sums = _line_sums(self._u[act], self._v[act], self._w[act])
+            # plain R² of the robust line over its inliers, the same for every method
+            v = self._v[self.inliers]
+            r = v - (slope*self._u[self.inliers] + intercept)
+            sst = ((v - v.mean())**2).sum() if v.size else 0.
+            self.rsqd = np.round(1 - (r*r).sum()/sst, decimals=2) if sst > 0 else np.nan
+        else:
+            slope, intercept, self.rsqd = _sums_line(self._sums)
+            self.inliers = self.mask.copy()
+        self.slope = slope
+        self.intercept = self._y0 + intercept - slope*self._x0
+
+    @property
+    def x(self):
+        return self._x[self.mask]
+
+    @property
+    def y(self):
+        return self._y[self.mask]
+
+    def _change(self, inds, keep):
+        """Put inds (of the data) in (keep=True) or out of the fit, O(len(inds)) for least squares"""
+        inds = np.asarray(inds, dtype=np.intp)
+        inds = np.unique(inds[self.mask[inds] != keep])
+        if inds.size:
+            self.mask[inds] = keep
+            if self.method not in ROBUST_FITS:
+                sums = _line_sums(self._u[inds], self._v[inds], self._w[inds])
+                self._sums = self._sums + sums if keep else self._sums - sums
+            self._update_params()
+        return inds.size
+
+    def remove(self, inds, redraw=True):
+        """Take points inds (of the data) out of the fit"""
+        if self._change(inds, False) and redraw:
+            self._update_plot()
+
+    def add(self, inds, redraw=True):
+        """Put points inds (of the data) back in the fit"""
+        if self._change(inds, True) and redraw:
+            self._update_plot()
+
+    def exclude(self, inds, redraw=True):
+        """Fit all data except inds (like AnnoteFinder.points.indices)"""
+        keep = np.ones(self.mask.size, dtype=bool)
+        keep[np.asarray(inds, dtype=np.intp)] = False
+        if self.method in ROBUST_FITS:
+            # one robust refit rather than one per direction
+            changed = (keep != self.mask).any()
+            self.mask = keep
+            if changed:
+                self._update_params()
+        else:
+            changed = self._change(np.flatnonzero(keep & ~self.mask), True)
+            changed += self._change(np.flatnonzero(~keep & self.mask), False)
+        if changed and redraw:
+            self._update_plot()
+
+    def set_method(self, method, weights=None, redraw=True, **robust_kw):
+        """Refit the same points with another method (weights default the current ones)"""
+        weights = self._w0 if weights is None else np.asarray(weights, dtype=np.float64)
+        self._check_method(method, weights)
+        self.method = method
+        self.robust_kw = robust_kw
+        self._w0 = self._w = weights
+        act = self.mask
+        self._sums = _line_sums(self._u[act], self._v[act], self._w[act])
+        self._update_params()
+        if redraw:
+            self._update_plot()
     
-    def update_fit(self, xnew, ynew):
+    def update_fit(self, xnew, ynew, weights=None):
         """Updates plot with new data"""
-        self.x = xnew
-        self.y = ynew
-        # get fit data
-        self.slope, self.intercept, self.rsqd = self.get_fit(self.x, self.y)
+        self._set_data(xnew, ynew, weights)
+        self._update_plot()
+
+    def update_ibe(self, wafer, run):
+        """Write slope, intercept and rsqd to IonTrim as m, n and rsqd (db_tools.update_ibe)"""
+        from .db_tools import update_ibe
+        update_ibe(wafer, run, float(self.slope), float(self.intercept), float(self.rsqd))
+
+    def _update_plot(self):
         # get data for ploting
         xl, yl, xs, yerrLower, yerrUpper, eq_txt = self._get_fit_data()
         
@@ -207,32 +627,38 @@ class FitLinear(object):
         
     def get_fit(self, xdata, ydata):
         """determine best fit line and fit parameters"""
-        # get Fit!!!
-        par = np.polyfit(xdata, ydata, 1, full=True)
-        # get line eq
-        slope = par[0][0]
-        intercept = par[0][1]
-        # coefficient of determination
-        variance = np.var(ydata)
-        residuals = np.var([(slope*xx + intercept - yy)  for xx, yy in zip(xdata, ydata)])
-        rsqd = np.round(1-residuals/variance, decimals=2)
-        return (slope, intercept, rsqd)
+        xdata = np.asarray(xdata, dtype=np.float64)
+        ydata = np.asarray(ydata, dtype=np.float64)
+        x0 = xdata.mean()
+        y0 = ydata.mean()
+        slope, intercept, rsqd = _sums_line(_line_sums(xdata - x0, ydata - y0))
+        return (slope, y0 + intercept - slope*x0, rsqd)
         
     def _get_fit_data(self):
         """gets extra data for plotting (line, l_yerr, u_yerr, txt)"""
+        x = self.x
+        u = self._u[self.mask]
+        w = self._w[self.mask]
         # get line
-        xl = [min(self.x), max(self.x)]
-        yl = [self.slope*xx + self.intercept  for xx in xl]
-        # get error bounds
-        yerr = [abs(self.slope*xx + self.intercept - yy)  for xx,yy in zip(self.x, self.y)]
-        par = np.polyfit(self.x, yerr, 2, full=True)
-        # sort the data (makes plot clean)
-        reorder = sorted(range(len(self.x)), key = lambda ii: self.x[ii])
-        xs = [self.x[ii] for ii in reorder]
-        ys = [self.x[ii] for ii in reorder]
+        xl = np.array([x.min(), x.max()]) if x.size else np.array([np.nan, np.nan])
+        yl = self.slope*xl + self.intercept
+        # get error bounds, quadratic least squares of |residual| on centered x
+        yerr = w*np.abs(self.slope*x + self.intercept - self.y)
+        n, su, suu, su3, su4 = self._sums[[0, 1, 3, 6, 7]]
+        A = np.array([[su4, su3, suu], [su3, suu, su], [suu, su, n]])
+        b = np.array([(u*u*yerr).sum(), (u*yerr).sum(), yerr.sum()])
+        try:
+            par = np.linalg.solve(A, b)
+        except np.linalg.LinAlgError:
+            par = np.array([0., 0., yerr.sum()/n if n > 0 else np.nan])
+        # smooth curves, drawn at band_points x values (not every point)
+        xs = np.linspace(xl[0], xl[1], self.band_points)
+        us = xs - self._x0
+        band = (par[0]*us + par[1])*us + par[2]
+        line = self.slope*xs + self.intercept
         # error lines
-        yerrUpper = [(xx*self.slope+self.intercept)+(par[0][0]*xx**2 + par[0][1]*xx + par[0][2]) for xx, yy in zip(xs, ys)]
-        yerrLower = [(xx*self.slope+self.intercept)-(par[0][0]*xx**2 + par[0][1]*xx + par[0][2]) for xx, yy in zip(xs, ys)]
+        yerrUpper = line + band
+        yerrLower = line - band
         # text to add to plot
         eq_txt = 'y=%0.2f$x + %0.2f$ \n$R^2 = %0.2f$' % (self.slope, self.intercept, self.rsqd)
 
@@ -288,25 +714,117 @@ def plot_wafer(mplax, size=[100, 100], center=[0,0], flatlocal=0):
     mplax.axis('off')
     return mplax
 
-def plot_wafermap(mplax, x, y, z, size=[100000, 100000], center=[0,0], resolution=100, flatlocal=0, vmin= None, vmax=None, bins=20):
-    """Plot Wafer Map"""
+class WaferInterpolator(object):
+    """Interpolation of wafer map values at fixed die positions.
+    The Delaunay triangulation of the die coordinates is made once; for each grid
+    the barycentric weights are kept as a sparse (grid points x dies) matrix, so
+    linear interpolation of another parameter or wafer is one sparse mat-vec
+    (z columns can be batched: z of shape (dies, k)).
+    Cubic (griddata's default Clough-Tocher) depends on gradients estimated from z,
+    so it is not a fixed matrix; it reuses the cached triangulation instead.
+
+    Use wafer_interpolator(x, y) to get the shared one for a die coordinate set.
 
+    Attributes:
+        points (np.array): (dies, 2) die coordinates.
+        tri (Delaunay): triangulation of points.
+    """
+
+    max_grids = 4
+
+    def __init__(self, x, y):
+        self.points = np.column_stack([np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)])
+        self.tri = Delaunay(self.points)
+        self._grids = OrderedDict()  # grid key: (sparse weights, inside hull mask)
+
+    def weights(self, xi, yi):
+        """Return (csr weights (xi.size x dies), inside hull mask) for grid xi, yi (cached)"""
+        xi = np.asarray(xi, dtype=np.float64)
+        yi = np.asarray(yi, dtype=np.float64)
+        key = _coords_key(xi, yi)
+        if key in self._grids:
+            self._grids.move_to_end(key)
+            return self._grids[key]
+        q = np.column_stack([xi.ravel(), yi.ravel()])
+        simplex = self.tri.find_simplex(q)
+        inside = simplex >= 0
+        T = self.tri.transform[simplex[inside]]
+        b = np.einsum('ijk,ik->ij', T[:, :2], q[inside] - T[:, 2])
+        bary = np.column_stack([b, 1 - b.sum(axis=1)])
+        rows = np.repeat(np.flatnonzero(inside), 3)
+        cols = self.tri.simplices[simplex[inside]].ravel()
+        W = sparse.csr_matrix((bary.ravel(), (rows, cols)), shape=(q.shape[0], self.points.shape[0]))
+        self._grids[key] = (W, inside)
+        if len(self._grids) > self.max_grids:
+            self._grids.popitem(last=False)
+        return W, inside
+
+    def __call__(self, z, xi, yi, method='linear'):
+        """Return z (dies,) or (dies, k) interpolated to grid xi, yi, shape xi.shape (+ (k,)).
+        NaN outside the convex hull of the dies like griddata.
+        """
+        xi = np.asarray(xi, dtype=np.float64)
+        z = np.asarray(z, dtype=np.float64)
+        if method == 'linear':
+            W, inside = self.weights(xi, yi)
+            zi = W @ z
+            zi[~inside] = np.nan
+        elif method == 'cubic':
+            zi = CloughTocher2DInterpolator(self.tri, z)(xi.ravel(), np.asarray(yi, dtype=np.float64).ravel())
+        else:
+            raise ValueError('method must be "linear" or "cubic"')
+        return zi.reshape(xi.shape + z.shape[1:])
+
+def _coords_key(x, y):
+    """Hash key of coordinate arrays"""
+    h = hashlib.blake2b(digest_size=16)
+    for a in (x, y):
+        a = np.ascontiguousarray(a, dtype=np.float64)
+        h.update(repr(a.shape).encode())
+        h.update(a.data)
+    return h.hexdigest()
+
+_interpolators = OrderedDict()
+INTERPOLATOR_CACHE_SIZE = 8
+
+def wafer_interpolator(x, y):
+    """Return the WaferInterpolator of die coordinates x, y, shared by every map with the same dies"""
+    key = _coords_key(x, y)
+    interp = _interpolators.get(key)
+    if interp is None:
+        interp = _interpolators[key] = WaferInterpolator(x, y)
+        if len(_interpolators) > INTERPOLATOR_CACHE_SIZE:
+            _interpolators.popitem(last=False)
+    else:
+        _interpolators.move_to_end(key)
+    return interp
+
+def wafermap_grid(x, y, z, size=[100000, 100000], center=[0,0], resolution=100, method='cubic'):
+    """Return xi, yi, zi: z (dies,) or (dies, k) at die x, y interpolated on the wafer grid of plot_wafermap"""
     cx = center[0]
     cy = center[1]
     x1 = cx-size[0]/2
     x2 = cx+size[0]/2
     y1 = cy-size[1]/2
     y2 = cy+size[1]/2
-    
+    # create coordinate arrays to vectorize function evaluations over a grid    
+    xi, yi = np.mgrid[x1:x2:resolution, y1:y2:resolution]
+    zi = wafer_interpolator(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))(z, xi, yi, method)
+    return xi, yi, zi
+
+def plot_wafermap(mplax, x, y, z, size=[100000, 100000], center=[0,0], resolution=100, flatlocal=0, vmin= None, vmax=None, bins=20, method='cubic'):
+    """Plot Wafer Map
+    method 'cubic' (like griddata) or 'linear' (cached sparse weights, fastest for many maps
+    of the same dies); see WaferInterpolator.
+    """
+    z = np.asarray(z, dtype=np.float64)
     if not vmin:
         vmin = np.min(z)
     if not vmax:
         vmax = np.max(z)
         
-    # create coordinate arrays to vectorize function evaluations over a grid    
-    xi, yi = np.mgrid[x1:x2:resolution, y1:y2:resolution]
     # interpolate z to grid
-    zi = sp.interpolate.griddata((x, y), z, (xi, yi), method='cubic')
+    xi, yi, zi = wafermap_grid(x, y, z, size, center, resolution, method)
     # Plot
     plot_wafer(mplax, size, flatlocal=flatlocal)
     levels = np.linspace(vmin, vmax, bins)
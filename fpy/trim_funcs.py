@@ -1,61 +1,212 @@
 # Stdlib imports
+import abc
 import os
 import csv
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 # Third-Party imports
 import pandas as pd
 import numpy as np
+try:
+    import numba
+except ImportError:
+    numba = None
 # Local imports
-from .basic_tools import user_input, filt_gt, filt_3sigma, filt_edge_percent
+from .basic_tools import user_input, filter_mask, gt
+from .file_funcs import find_base_path, find_test_path, get_filename, get_target_param, read_waferview, write_ibe
+
+class RateModel(abc.ABC):
+    """Vectorized removal rate: removal[nm] = model(shift) on whole np.arrays.
+    Subclasses implement __call__(shift) for arrays (scalars work too).
+    """
+
+    @abc.abstractmethod
+    def __call__(self, shift):
+        """Return removal[nm] for shift[MHz]"""
+
+class LinearRate(RateModel):
+    """Scia rate eq: removal[nm] = a[nm/s] * (shift[MHz] * b[s/MHz] + c[s])
+
+    Attributes:
+        a, b, c (float): rate coefficients as written to the ibe header.
+        use_numba (bool): evaluate with a numba kernel (if numba is installed).
+    """
+
+    def __init__(self, a, b, c, use_numba=False):
+        self.a = float(a)
+        self.b = float(b)
+        self.c = float(c)
+        self.use_numba = use_numba and _linear_kernel is not None
+
+    def __call__(self, shift):
+        if self.use_numba and np.ndim(shift):
+            return _linear_kernel(np.ascontiguousarray(shift, dtype=np.float64), self.a, self.b, self.c)
+        return self.a*(np.asarray(shift, dtype=np.float64)*self.b + self.c)
+
+    @property
+    def coefs(self):
+        """[a, b, c] as passed to write_ibe"""
+        return [self.a, self.b, self.c]
+
+    def __repr__(self):
+        return 'LinearRate(a=%s, b=%s, c=%s)' % (self.a, self.b, self.c)
+
+class PolyRate(RateModel):
+    """Polynomial rate eq: removal[nm] = np.polyval(coefs, shift), highest power first."""
+
+    def __init__(self, coefs):
+        self.coefs = [float(p) for p in coefs]
+
+    def __call__(self, shift):
+        return np.polyval(self.coefs, np.asarray(shift, dtype=np.float64))
+
+    def __repr__(self):
+        return 'PolyRate(%s)' % self.coefs
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _linear_kernel(shift, a, b, c):
+        out = np.empty_like(shift)
+        for ii in range(shift.shape[0]):
+            out[ii] = a*(shift[ii]*b + c)
+        return out
+else:
+    _linear_kernel = None
+
+def apply_rate(rate_func, shift):
+    """Return rate_func(shift) for a np.array shift.
+    RateModels and plain arithmetic functions (like partial(rate_func_base, a=a, b=b, c=c))
+    run once on the whole array, functions that only take scalars fall back to one call per value.
+    """
+    shift = np.asarray(shift, dtype=np.float64)
+    if isinstance(rate_func, RateModel):
+        return rate_func(shift)
+    try:
+        out = np.asarray(rate_func(shift), dtype=np.float64)
+        if out.shape == shift.shape:
+            return out
+    except (TypeError, ValueError):
+        pass
+    return np.fromiter((rate_func(s) for s in shift), dtype=np.float64, count=shift.size)
+
+def _clip_ibe(x, y, shift, ddof):
+    """Return ibe dataframe (x, y, shift) with shift clipped to [max(0, av - 3sd), av + 3sd]"""
+    av = np.nanmean(shift)
+    sd = np.nanstd(shift, ddof=ddof)
+    return av, sd, pd.DataFrame({'x': x, 'y': y, 'shift': np.clip(shift, max([0, av - 3*sd]), av + 3*sd)})
 
 def trimToFreq(target, targ_param, df, flatLocation, rate_func):
-    """ToDo
+    """Return ibe dataframe (x[mm], y[mm], shift[nm]) to trim df[targ_param] to target.
      Args:
-        target (int, float): ToDO
+        target (int, float): target frequency.
+        targ_param (str): column of df with the measured frequency.
+        df (pd.dataframe): WaferView dataframe with DieX and DieY [um].
+        flatLocation (int, str): wafer flat location, 180 rotates x, y.
+        rate_func (RateModel, func): removal[nm] = rate_func(target - df[targ_param]).
     """
     # remove 0 or negative values from target parameter
-    df = filt_gt(df, [targ_param])
-    
+    keep, _ = filter_mask(df, gt(0), [targ_param])
+
     # get x and y in mm
-    x = df['DieX']/1000
-    y = df['DieY']/1000
+    diex = df['DieX'].to_numpy(dtype=np.float64)[keep]/1000
+    diey = df['DieY'].to_numpy(dtype=np.float64)[keep]/1000
+    x, y = diex, diey
     if int(flatLocation)==180:
-        x = -df['DieY']/1000
-        y = df['DieX']/1000
+        x, y = -diey, diex
     # create shift column
-    shift = target - df[targ_param]
+    shift = target - df[targ_param].to_numpy(dtype=np.float64)[keep]
     # apply rate function to shift to get [nm] from [Hz]
-    shift = shift.apply(rate_func)
-    
-    # create dataframe from arrays
-    ibe = pd.DataFrame(np.array([x, y, shift]).T, columns = ['x', 'y', 'shift'])
-    
-    # get values for filtering
-    av = ibe['shift'].values.mean()
-    sd = ibe['shift'].values.std()
-    print(av, sd)
+    shift = apply_rate(rate_func, shift)
+
     # Filter ibe
-    # clip sets value to bound (lower or upper) per column
+    # clip sets value to bound (lower or upper)
     # clip outside 3 sd --> lower = av - 3*sd; upper = av + 3*sd
+    av, sd, ibe_filt = _clip_ibe(x, y, shift, ddof=0)
+    print(av, sd)
     print(av + 3*sd)
-    lower_bounds = pd.Series({'x': -np.inf, 'y': -np.inf, 'shift': max([0, av - 3*sd])})
-    upper_bounds = pd.Series({'x': np.inf, 'y': np.inf, 'shift': av + 3*sd})                      
-    ibe_filt = ibe.clip(lower=lower_bounds, upper=upper_bounds, axis=1)
     return ibe_filt
 
 def trimToThickness(target, df):
-    x = df['Die x (mm)']
-    y = df['Die y (mm)']
-    shift = (df['Site 1 Layer 1 Thickness (A)'] - target)/10 # A -> nm
-    shift = shift.rename('Shift')
-
-    ibe = pd.DataFrame(np.array([x,y,shift]).T, columns = ['x', 'y', 'shift'])
+    """Return ibe dataframe (x[mm], y[mm], shift[nm]) to trim Filmetrics thickness [A] to target [A]"""
+    x = df['Die x (mm)'].to_numpy(dtype=np.float64)
+    y = df['Die y (mm)'].to_numpy(dtype=np.float64)
+    shift = (df['Site 1 Layer 1 Thickness (A)'].to_numpy(dtype=np.float64) - target)/10 # A -> nm
 
-    av = shift.mean()
-    sd = shift.std()
-    
-    # clip sets value to bound (lower or upper) per column
+    # clip sets value to bound (lower or upper)
     # clip outside 3 sd --> lower = av - 3*sd; upper = av + 3*sd
-    lower_bounds = pd.Series({'x': -np.inf, 'y': -np.inf, 'shift': max([0, av - 3*sd])})
-    upper_bounds = pd.Series({'x': -np.inf, 'y': -np.inf, 'shift': av + 3*sd})                      
-    ibe_filt = ibe.clip(lower=lower_bounds, upper=upper_bounds, axis=1)
+    av, sd, ibe_filt = _clip_ibe(x, y, shift, ddof=1)
     return ibe_filt
+
+def _trim_wafer(job, base_path, overwrite):
+    """Make and write the ibe of one manifest row, returns summary dict (plain, for process pools)"""
+    start = time.perf_counter()
+    out = {'wafer': job['wafer'], 'path': None, 'target_param': None, 'dies': 0,
+           'mean': np.nan, 'std': np.nan, 'min': np.nan, 'max': np.nan, 'seconds': 0., 'error': None}
+    try:
+        full_path = find_test_path(base_path, str(job['freq']), str(job['wafer']), job['test_step'],
+                                   job['d8_num'], job.get('test_spec', ''))
+        fname = get_filename(full_path, job.get('file_num', -1))
+        if not fname:
+            raise FileNotFoundError('No test file in %s' % full_path)
+        path = os.path.join(full_path, fname)
+        out['path'] = path
+        summary = read_waferview(path, usecols=[job['target_param']] if job.get('target_param') else None)
+        target_param = get_target_param(summary, job['test_step'], job.get('target_param'))
+        out['target_param'] = target_param
+        flat = job.get('flat')
+        if flat is None or flat != flat:  # None or NaN from a dataframe manifest
+            flat = summary.header['FlatLocation']
+        rate = LinearRate(job['a'], job['b'], job['c'])
+        ibe_filt = trimToFreq(float(job['target']), target_param, summary.dataframe, flat, rate)
+        backup = path + '.ibe'
+        if os.path.exists(backup) and not overwrite:
+            raise FileExistsError('%s exists, use overwrite=True' % backup)
+        target = str(job['target']) + ' MHz'
+        # save backup and to run on scia, one encode
+        write_ibe([backup, os.path.join(full_path, str(job['wafer']) + '.ibe')], ibe_filt, target, rate.coefs)
+        shift = ibe_filt['shift'].to_numpy()
+        out.update(dies=shift.size, mean=shift.mean(), std=shift.std(), min=shift.min(), max=shift.max())
+    except Exception as e:
+        out['error'] = '%s: %s' % (type(e).__name__, e)
+    out['seconds'] = time.perf_counter() - start
+    return out
+
+def trim_lot(manifest, max_workers=None, processes=True, overwrite=False, write_db=True, base_path=None):
+    """Make the trim-to-frequency ibe files of a whole lot in parallel.
+    For each manifest row: load the wafer map, trimToFreq with LinearRate(a, b, c), write the
+    backup (<test file>.ibe) and Scia (<wafer>.ibe) files. Then the a, b, c of every wafer that
+    worked go to IonTrim with one db_tools.upsert_ibe call.
+     Args:
+        manifest (pd.dataframe, list): rows with wafer, freq, test_step, d8_num, target, a, b, c
+            and optionally run (needed for the db), flat (default header FlatLocation),
+            test_spec, file_num (default -1) and target_param.
+        max_workers (:obj:`int`, optional): parallel wafers, default cpu count.
+        processes (:obj:`bool`, optional): use processes (cores), else threads.
+        overwrite (:obj:`bool`, optional): replace existing backup ibe files.
+        write_db (:obj:`bool`, optional): upsert a, b, c to IonTrim (rows with a run).
+        base_path (:obj:`str`, optional): default find_base_path().
+    Returns:
+        pd.dataframe: per wafer path, target_param, dies, removal mean/std/min/max,
+            seconds, error and db outcome.
+    """
+    if isinstance(manifest, pd.DataFrame):
+        manifest = manifest.to_dict('records')
+    manifest = list(manifest)
+    if base_path is None:
+        base_path = find_base_path()
+    pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with pool(max_workers=max_workers) as ex:
+        futures = [ex.submit(_trim_wafer, job, base_path, overwrite) for job in manifest]
+        summary = pd.DataFrame([fut.result() for fut in futures])
+    summary['db'] = None
+    if write_db:
+        # a dataframe manifest has NaN, not None, where run is missing
+        records = [{'fk_wafer': job['wafer'], 'run': int(job['run']), 'a': job['a'], 'b': job['b'], 'c': job['c']}
+                   for job, err in zip(manifest, summary['error'])
+                   if pd.isna(err) and pd.notna(job.get('run'))]
+        if records:
+            from .db_tools import upsert_ibe
+            outcome = upsert_ibe(records).set_index(['fk_wafer', 'run'])['outcome']
+            summary['db'] = [outcome.get((job['wafer'], int(job['run']))) if pd.notna(job.get('run')) else None
+                             for job in manifest]
+    return summary